@@ -4,12 +4,19 @@ import uuid
 import json
 import urllib.parse
 import aiohttp
-import sys
+import logging
 import random
 import base64
 import io
+import time
+import functools
 from PIL import Image
 
+import log
+from log import bind_log_context
+
+logger = logging.getLogger(__name__)
+
 # --- 設定 ---
 CLIENT_ID = str(uuid.uuid4())
 WORKFLOW_FILE_TXT2IMG = "workflow/txt2img.json"
@@ -22,71 +29,153 @@ IMAGE_SIZES = {
     'horizontal': (1216, 832)
 }
 
+# 草稿模式:較少的取樣步數與較小的 latent
+DRAFT_STEPS = 12
+DRAFT_SCALE = 0.5
+
+# 預熱用的最小工作流程:極小 latent(對齊後為 64x64)與 1 步取樣
+WARMUP_SCALE = 0.05
+WARMUP_STEPS = 1
+
+# 各階段逾時預設值(秒)
+DEFAULT_TIMEOUTS = {
+    'upload': 30,        # 上傳輸入圖片
+    'submit': 15,        # 連線 WebSocket 與提交 prompt
+    'first_event': 120,  # 提交後到此 prompt 開始執行
+    'idle': 120,         # 兩次進度事件之間的最長間隔
+    'total': 900,        # 單張圖片的總執行時間
+}
+
+
+def new_seed():
+    return random.randint(1, 4294967294)
+
+
+def scaled_size(size, scale=1.0):
+    """依比例縮放圖片尺寸,並對齊到 8 的倍數(latent 的最小單位)"""
+    width, height = IMAGE_SIZES.get(size, IMAGE_SIZES['vertical'])
+    if scale == 1.0:
+        return width, height
+    return max(64, int(width * scale) // 8 * 8), max(64, int(height * scale) // 8 * 8)
+
+
+@functools.lru_cache(maxsize=None)
+def template_checkpoint(mode):
+    """取得工作流程模板使用的 checkpoint 名稱,供快取排程判斷是否共用模型"""
+    path = WORKFLOW_FILE_IMG2IMG if mode.startswith('img2img') else WORKFLOW_FILE_TXT2IMG
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            workflow = json.load(f)
+    except Exception:
+        return None
+    for node_data in workflow.values():
+        if "ckpt_name" in node_data.get("inputs", {}):
+            return node_data["inputs"]["ckpt_name"]
+    return None
+
+
+# --- 任務狀態追蹤(供看門狗使用)---
+def mark_job_state(job_state, stage=None):
+    now = time.monotonic()
+    job_state['last_activity'] = now
+    if stage and stage != job_state.get('stage'):
+        # 累計每個階段花費的時間,供任務紀錄分析
+        previous = job_state.get('stage')
+        if previous:
+            durations = job_state.setdefault('stage_durations', {})
+            durations[previous] = durations.get(previous, 0) + now - job_state.get('stage_started', now)
+        job_state['stage'] = stage
+        job_state['stage_started'] = now
 
-# --- Progress Bar ---
-def print_progress_bar(iteration, total, prefix='', suffix='', length=50, fill='█'):
-    percent = f"{100 * (iteration / float(total)):.1f}"
-    filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
-    sys.stdout.write(f'\r{prefix} |{bar}| {percent}% {suffix}')
-    sys.stdout.flush()
-    if iteration >= total:
-        print()  # 完成後換行
 
 # --- 上傳圖片至 ComfyUI ---
-async def upload_image_to_comfyui(image_bytes, server_address):
+def encode_png(image_bytes):
+    """
+    把使用者上傳的圖片轉成 PNG(CPU 密集,在執行緒中執行)。
+    無法解碼時拋出例外,應在接受請求時就呼叫,不要留到上傳給後端時才失敗
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img_byte_arr = io.BytesIO()
+        img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+async def upload_image_to_comfyui(image_bytes, server_address, timeout=DEFAULT_TIMEOUTS['upload']):
+    """上傳 PNG 圖片(已經過 encode_png);失敗只會來自網路或後端"""
     url = f"http://{server_address}/upload/image"
     
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        
         filename = f"input_{uuid.uuid4().hex[:8]}.png"
         
         form = aiohttp.FormData()
-        form.add_field('image', img_byte_arr, filename=filename, content_type='image/png')
+        form.add_field('image', image_bytes, filename=filename, content_type='image/png')
         
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
             async with session.post(url, data=form) as resp:
                 if resp.status == 200:
                     result = await resp.json()
                     uploaded_name = result.get('name', filename)
-                    print(f"[DEBUG] 圖片已上傳: {uploaded_name}")
+                    logger.debug("圖片已上傳: %s", uploaded_name)
                     return uploaded_name
                 else:
-                    print(f"[錯誤] 上傳圖片失敗，狀態碼: {resp.status}")
+                    logger.error("上傳圖片失敗，狀態碼: %s", resp.status)
                     return None
+    except asyncio.TimeoutError:
+        logger.error("上傳圖片逾時(超過 %s 秒)", timeout)
+        return None
     except Exception as e:
-        print(f"[錯誤] 上傳圖片時發生例外: {e}")
+        logger.error("上傳圖片時發生例外: %s", e)
         return None
 
 
-# --- 主任務函式 ---
-# --- 文生圖主任務函式 ---
-async def get_image_txt2img(positive_prompt, negative_prompt, server_address, size='vertical'):
-    print("\n--- [DEBUG] 進入 get_image_txt2img 函式 ---")
-    print(f"[DEBUG] 圖片尺寸: {size} -> {IMAGE_SIZES.get(size, IMAGE_SIZES['vertical'])}")
-
-    # === 讀取 workflow ===
+# --- 建立工作流程 ---
+def load_workflow(path):
+    """讀取工作流程模板並整理節點標題;失敗時返回 (None, None, 錯誤訊息)"""
     try:
-        with open(WORKFLOW_FILE_TXT2IMG, 'r', encoding='utf-8') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             prompt_workflow = json.load(f)
-        print(f"[DEBUG] 工作流程檔案 '{WORKFLOW_FILE_TXT2IMG}' 已成功載入。")
+        logger.debug("工作流程檔案 '%s' 已成功載入。", path)
     except Exception as e:
-        return None, f"錯誤:讀取工作流程檔案失敗 - {e}"
+        return None, None, f"錯誤:讀取工作流程檔案失敗 - {e}"
+
+    node_titles = {
+        node_id: node_data.get("_meta", {}).get("title", f"Node {node_id}")
+        for node_id, node_data in prompt_workflow.items()
+    }
+    return prompt_workflow, node_titles, None
+
+
+def apply_seed_and_steps(prompt_workflow, node_titles, seed=None, steps=None):
+    """同步更新所有 seed 節點,並在指定時覆寫取樣步數;返回更新的 seed 節點數"""
+    random_seed = seed if seed is not None else new_seed()
+    seed_nodes_updated = 0
+    
+    for node_id, node_data in prompt_workflow.items():
+        if "seed" in node_data.get("inputs", {}):
+            prompt_workflow[node_id]["inputs"]["seed"] = random_seed
+            logger.debug("節點 '%s' 設定 seed: %s", node_titles.get(node_id, node_id), random_seed)
+            seed_nodes_updated += 1
+        if steps and "steps" in node_data.get("inputs", {}):
+            prompt_workflow[node_id]["inputs"]["steps"] = steps
+            logger.debug("節點 '%s' 設定取樣步數: %s", node_titles.get(node_id, node_id), steps)
+    
+    if seed_nodes_updated > 0:
+        logger.debug("共更新了 %d 個 seed 節點", seed_nodes_updated)
+    return seed_nodes_updated
+
+
+def build_txt2img_workflow(positive_prompt, negative_prompt, size='vertical', seed=None, steps=None, scale=1.0):
+    """返回 (prompt_workflow, node_titles, 錯誤訊息)"""
+    prompt_workflow, node_titles, error_message = load_workflow(WORKFLOW_FILE_TXT2IMG)
+    if error_message:
+        return None, None, error_message
 
     # === 尋找 prompt 節點和 empty latent 節點 ===
     pos_prompt_node_id = None
     neg_prompt_node_id = None
     empty_latent_node_id = None
-    node_titles = {}
 
-    for node_id, node_data in prompt_workflow.items():
-        node_titles[node_id] = node_data.get("_meta", {}).get("title", f"Node {node_id}")
-        title = node_data.get("_meta", {}).get("title", "")
-        
+    for node_id, title in node_titles.items():
         if title == "Positive Prompt Loader":
             pos_prompt_node_id = node_id
         elif title == "Negative Prompt Loader":
@@ -95,57 +184,33 @@ async def get_image_txt2img(positive_prompt, negative_prompt, server_address, si
             empty_latent_node_id = node_id
 
     if not pos_prompt_node_id or not neg_prompt_node_id:
-        return None, "錯誤:找不到 'Positive Prompt Loader' 或 'Negative Prompt Loader' 節點。"
+        return None, None, "錯誤:找不到 'Positive Prompt Loader' 或 'Negative Prompt Loader' 節點。"
     
     if not empty_latent_node_id:
-        return None, "錯誤:找不到 'Empty latent' 節點。"
+        return None, None, "錯誤:找不到 'Empty latent' 節點。"
 
     # === 更新提示詞 ===
     prompt_workflow[pos_prompt_node_id]["inputs"]["text"] = positive_prompt
     prompt_workflow[neg_prompt_node_id]["inputs"]["text"] = negative_prompt
     
     # === 更新圖片尺寸 ===
-    width, height = IMAGE_SIZES.get(size, IMAGE_SIZES['vertical'])
+    width, height = scaled_size(size, scale)
     prompt_workflow[empty_latent_node_id]["inputs"]["width"] = width
     prompt_workflow[empty_latent_node_id]["inputs"]["height"] = height
-    print(f"[DEBUG] 設定圖片尺寸: {width}x{height}")
+    logger.debug("設定圖片尺寸: %dx%d", width, height)
     
     # === 設定隨機 seed(同步更新所有 seed 節點)===
-    random_seed = random.randint(1, 4294967294)
-    seed_nodes_updated = 0
+    if not apply_seed_and_steps(prompt_workflow, node_titles, seed, steps):
+        logger.warning("未找到任何 seed 節點,將使用工作流程中的預設值")
     
-    for node_id, node_data in prompt_workflow.items():
-        if "seed" in node_data.get("inputs", {}):
-            prompt_workflow[node_id]["inputs"]["seed"] = random_seed
-            print(f"[DEBUG] 節點 '{node_titles.get(node_id, node_id)}' 設定 seed: {random_seed}")
-            seed_nodes_updated += 1
-    
-    if seed_nodes_updated > 0:
-        print(f"[DEBUG] 共更新了 {seed_nodes_updated} 個 seed 節點")
-    else:
-        print("[WARNING] 未找到任何 seed 節點,將使用工作流程中的預設值")
-    
-    return await execute_workflow(prompt_workflow, server_address, node_titles)
+    return prompt_workflow, node_titles, None
 
 
-# --- 圖生圖主任務函式 ---
-async def get_image_img2img(positive_prompt, negative_prompt, input_image_bytes, server_address, size='vertical', denoise=0.75):
-    print("\n--- [DEBUG] 進入 get_image_img2img 函式 ---")
-    print(f"[DEBUG] 圖片尺寸: {size} -> {IMAGE_SIZES.get(size, IMAGE_SIZES['vertical'])}")
-    print(f"[DEBUG] 去噪強度: {denoise}")
-
-    # === 上傳輸入圖片 ===
-    uploaded_filename = await upload_image_to_comfyui(input_image_bytes, server_address)
-    if not uploaded_filename:
-        return None, "錯誤:無法上傳輸入圖片到 ComfyUI"
-
-    # === 讀取 img2img workflow ===
-    try:
-        with open(WORKFLOW_FILE_IMG2IMG, 'r', encoding='utf-8') as f:
-            prompt_workflow = json.load(f)
-        print(f"[DEBUG] 工作流程檔案 '{WORKFLOW_FILE_IMG2IMG}' 已成功載入。")
-    except Exception as e:
-        return None, f"錯誤:讀取工作流程檔案失敗 - {e}"
+def build_img2img_workflow(positive_prompt, negative_prompt, uploaded_filename, size='vertical', denoise=0.75, seed=None, steps=None, scale=1.0):
+    """返回 (prompt_workflow, node_titles, 錯誤訊息)"""
+    prompt_workflow, node_titles, error_message = load_workflow(WORKFLOW_FILE_IMG2IMG)
+    if error_message:
+        return None, None, error_message
 
     # === 尋找必要節點 ===
     pos_prompt_node_id = None
@@ -153,12 +218,8 @@ async def get_image_img2img(positive_prompt, negative_prompt, input_image_bytes,
     load_image_node_id = None
     latent_resize_node_id = None
     ksampler_node_id = None
-    node_titles = {}
 
-    for node_id, node_data in prompt_workflow.items():
-        node_titles[node_id] = node_data.get("_meta", {}).get("title", f"Node {node_id}")
-        title = node_data.get("_meta", {}).get("title", "")
-        
+    for node_id, title in node_titles.items():
         if title == "Positive Prompt Loader":
             pos_prompt_node_id = node_id
         elif title == "Negative Prompt Loader":
@@ -167,17 +228,17 @@ async def get_image_img2img(positive_prompt, negative_prompt, input_image_bytes,
             load_image_node_id = node_id
         elif title == "Latent resize":
             latent_resize_node_id = node_id
-        elif title == "KSampler":
+        elif title == "KSampler" or prompt_workflow[node_id].get("class_type") == "KSampler":
             ksampler_node_id = node_id
 
     if not pos_prompt_node_id or not neg_prompt_node_id:
-        return None, "錯誤:找不到 'Positive Prompt Loader' 或 'Negative Prompt Loader' 節點。"
+        return None, None, "錯誤:找不到 'Positive Prompt Loader' 或 'Negative Prompt Loader' 節點。"
     
     if not load_image_node_id:
-        return None, "錯誤:找不到 'Load image' 節點。"
+        return None, None, "錯誤:找不到 'Load image' 節點。"
     
     if not latent_resize_node_id:
-        return None, "錯誤:找不到 'Latent resize' 節點。"
+        return None, None, "錯誤:找不到 'Latent resize' 節點。"
 
     # === 更新提示詞 ===
     prompt_workflow[pos_prompt_node_id]["inputs"]["text"] = positive_prompt
@@ -185,143 +246,525 @@ async def get_image_img2img(positive_prompt, negative_prompt, input_image_bytes,
     
     # === 更新載入圖片節點 ===
     prompt_workflow[load_image_node_id]["inputs"]["image"] = uploaded_filename
-    print(f"[DEBUG] 載入原圖: {uploaded_filename}")
+    logger.debug("載入原圖: %s", uploaded_filename)
     
     # === 更新圖片尺寸 ===
-    width, height = IMAGE_SIZES.get(size, IMAGE_SIZES['vertical'])
+    width, height = scaled_size(size, scale)
     prompt_workflow[latent_resize_node_id]["inputs"]["width"] = width
     prompt_workflow[latent_resize_node_id]["inputs"]["height"] = height
-    print(f"[DEBUG] 設定圖片尺寸: {width}x{height}")
+    logger.debug("設定圖片尺寸: %dx%d", width, height)
     
     # === 更新去噪強度 ===
     if ksampler_node_id:
         prompt_workflow[ksampler_node_id]["inputs"]["denoise"] = denoise
-        print(f"[DEBUG] 設定去噪強度: {denoise}")
+        logger.debug("設定去噪強度: %s", denoise)
     
     # === 設定隨機 seed ===
-    random_seed = random.randint(1, 4294967294)
-    seed_nodes_updated = 0
+    apply_seed_and_steps(prompt_workflow, node_titles, seed, steps)
     
-    for node_id, node_data in prompt_workflow.items():
-        if "seed" in node_data.get("inputs", {}):
-            prompt_workflow[node_id]["inputs"]["seed"] = random_seed
-            print(f"[DEBUG] 節點 '{node_titles.get(node_id, node_id)}' 設定 seed: {random_seed}")
-            seed_nodes_updated += 1
+    return prompt_workflow, node_titles, None
+
+
+# --- 主任務函式 ---
+# --- 文生圖主任務函式 ---
+async def get_image_txt2img(positive_prompt, negative_prompt, server_address, size='vertical', timeouts=None, job_state=None, seed=None, steps=None, scale=1.0):
+    job_state = {} if job_state is None else job_state
+    mark_job_state(job_state, 'prepare')
+    logger.debug("進入 get_image_txt2img 函式,圖片尺寸: %s", size)
+
+    prompt_workflow, node_titles, error_message = build_txt2img_workflow(
+        positive_prompt, negative_prompt, size, seed, steps, scale
+    )
+    if error_message:
+        return None, error_message
     
-    if seed_nodes_updated > 0:
-        print(f"[DEBUG] 共更新了 {seed_nodes_updated} 個 seed 節點")
+    return await execute_workflow(prompt_workflow, server_address, node_titles, timeouts, job_state)
+
+
+# --- 圖生圖主任務函式 ---
+async def get_image_img2img(positive_prompt, negative_prompt, input_image_bytes, server_address, size='vertical', denoise=0.75, timeouts=None, job_state=None, seed=None, steps=None, scale=1.0):
+    timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+    job_state = {} if job_state is None else job_state
+    mark_job_state(job_state, 'prepare')
+    logger.debug("進入 get_image_img2img 函式,圖片尺寸: %s,去噪強度: %s", size, denoise)
+
+    # === 上傳輸入圖片 ===
+    mark_job_state(job_state, 'upload')
+    uploaded_filename = await upload_image_to_comfyui(input_image_bytes, server_address, timeouts['upload'])
+    if not uploaded_filename:
+        return None, "錯誤:無法上傳輸入圖片到 ComfyUI"
+    mark_job_state(job_state, 'prepare')
+
+    prompt_workflow, node_titles, error_message = build_img2img_workflow(
+        positive_prompt, negative_prompt, uploaded_filename, size, denoise, seed, steps, scale
+    )
+    if error_message:
+        return None, error_message
     
-    return await execute_workflow(prompt_workflow, server_address, node_titles)
+    return await execute_workflow(prompt_workflow, server_address, node_titles, timeouts, job_state)
+
+
+# --- 多提示詞文生圖主任務函式 ---
+async def get_images_txt2img_batch(positive_prompts, negative_prompt, server_address, size='vertical', timeouts=None, job_state=None, seeds=None, steps=None, scale=1.0, on_result=None):
+    """
+    每個正向提示詞各建一個 prompt,一次全部提交讓 ComfyUI 背靠背執行,
+    每張完成時呼叫 on_result(index, image_bytes, error_message)。
+    返回與 positive_prompts 對應的 [(image_bytes, error_message), ...]
+    """
+    job_state = {} if job_state is None else job_state
+    seeds = seeds or [None] * len(positive_prompts)
+    mark_job_state(job_state, 'prepare')
+
+    prompt_workflows = []
+    node_titles = {}
+    for positive_prompt, seed in zip(positive_prompts, seeds):
+        prompt_workflow, node_titles, error_message = build_txt2img_workflow(
+            positive_prompt, negative_prompt, size, seed, steps, scale
+        )
+        if error_message:
+            results = [(None, error_message)] * len(positive_prompts)
+            if on_result:
+                for index in range(len(positive_prompts)):
+                    on_result(index, None, error_message)
+            return results
+        prompt_workflows.append(prompt_workflow)
+
+    return await execute_workflows(prompt_workflows, server_address, node_titles, timeouts, job_state, on_result)
+
+
+# --- 批次圖生圖主任務函式 ---
+async def get_images_img2img_batch(positive_prompt, negative_prompt, input_images, server_address, size='vertical', denoise=0.75, timeouts=None, job_state=None, seeds=None, steps=None, scale=1.0, on_result=None):
+    """
+    同時上傳所有輸入圖片,再一次提交所有 prompt 讓 ComfyUI 背靠背執行,
+    每張完成時呼叫 on_result(index, image_bytes, error_message)。
+    返回與 input_images 對應的 [(image_bytes, error_message), ...]
+    """
+    timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+    job_state = {} if job_state is None else job_state
+    seeds = seeds or [None] * len(input_images)
+    results = [None] * len(input_images)
+
+    def fail(index, error_message):
+        results[index] = (None, error_message)
+        if on_result:
+            on_result(index, None, error_message)
+
+    # === 同時上傳所有輸入圖片 ===
+    mark_job_state(job_state, 'upload')
+    uploaded_filenames = await asyncio.gather(*(
+        upload_image_to_comfyui(image_bytes, server_address, timeouts['upload'])
+        for image_bytes in input_images
+    ))
+    if not any(uploaded_filenames):
+        # 停在 upload 階段,讓呼叫端視為後端問題並換後端重試
+        for index in range(len(input_images)):
+            fail(index, "錯誤:無法上傳輸入圖片到 ComfyUI")
+        return results
+    mark_job_state(job_state, 'prepare')
+
+    indices = []
+    prompt_workflows = []
+    node_titles = {}
+    for index, uploaded_filename in enumerate(uploaded_filenames):
+        if not uploaded_filename:
+            fail(index, "錯誤:無法上傳輸入圖片到 ComfyUI")
+            continue
+        prompt_workflow, node_titles, error_message = build_img2img_workflow(
+            positive_prompt, negative_prompt, uploaded_filename, size, denoise, seeds[index], steps, scale
+        )
+        if error_message:
+            # 工作流程設定錯誤,每張都會失敗
+            for i in range(len(input_images)):
+                if results[i] is None:
+                    fail(i, error_message)
+            return results
+        indices.append(index)
+        prompt_workflows.append(prompt_workflow)
+
+    if not prompt_workflows:
+        return results
+
+    def forward(position, image_bytes, error_message):
+        index = indices[position]
+        results[index] = (image_bytes, error_message)
+        if on_result:
+            on_result(index, image_bytes, error_message)
+
+    await execute_workflows(prompt_workflows, server_address, node_titles, timeouts, job_state, forward)
+    # 把各 prompt 的節點統計對應回 input_images 的順序(上傳失敗的沒有 prompt)
+    for key in ('prompt_nodes', 'prompt_cached'):
+        per_input = [0] * len(input_images)
+        for position, index in enumerate(indices):
+            per_input[index] = job_state[key][position]
+        job_state[key] = per_input
+    return results
+
+
+# --- 預熱後端 ---
+async def warm_up_backend(server_address, timeouts=None):
+    """
+    提交每個工作流程模板的最小版本,讓 checkpoint 權重與 CLIP 常駐記憶體,
+    使用者的第一個請求就不必等待模型載入。返回錯誤訊息列表
+    """
+    tiny_image = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(tiny_image, format='PNG')
+
+    errors = []
+    _, error_message = await get_image_txt2img(
+        "warm up", "", server_address, 'square', timeouts,
+        steps=WARMUP_STEPS, scale=WARMUP_SCALE
+    )
+    if error_message:
+        errors.append(f"txt2img: {error_message}")
+
+    _, error_message = await get_image_img2img(
+        "warm up", "", tiny_image.getvalue(), server_address, 'square', 1.0, timeouts,
+        steps=WARMUP_STEPS, scale=WARMUP_SCALE
+    )
+    if error_message:
+        errors.append(f"img2img: {error_message}")
+    return errors
 
 
 # --- 執行工作流程 ---
-async def execute_workflow(prompt_workflow, server_address, node_titles):
-    payload = {"prompt": prompt_workflow, "client_id": CLIENT_ID}
+async def execute_workflow(prompt_workflow, server_address, node_titles, timeouts=None, job_state=None):
+    results = await execute_workflows([prompt_workflow], server_address, node_titles, timeouts, job_state)
+    return results[0]
+
+
+async def execute_workflows(prompt_workflows, server_address, node_titles, timeouts=None, job_state=None, on_result=None):
+    """
+    在同一個 WebSocket 連線上連續提交多個 prompt,讓 ComfyUI 背靠背執行。
+    每個 prompt 結束時呼叫 on_result(index, image_bytes, error_message)(不可阻塞),
+    返回 [(image_bytes, error_message), ...]
+    """
+    timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+    job_state = {} if job_state is None else job_state
+    results = [None] * len(prompt_workflows)
+    prompt_ids = {}  # prompt_id -> index
+    total_deadline = None
+    job_state['total_nodes'] = sum(len(prompt_workflow) for prompt_workflow in prompt_workflows)
+    job_state['cached_nodes'] = 0
+    # 各 prompt 的節點數與命中快取的節點數,供統計只計入成功的 prompt
+    job_state['prompt_nodes'] = [len(prompt_workflow) for prompt_workflow in prompt_workflows]
+    job_state['prompt_cached'] = [0] * len(prompt_workflows)
+    # 每次連線使用獨立的 client id,同時有多個連線時 ComfyUI 才不會把事件送錯連線
+    client_id = f"{CLIENT_ID}-{uuid.uuid4().hex[:8]}"
+
+    def finish(index, image_bytes, error_message):
+        if results[index] is not None:
+            return
+        results[index] = (image_bytes, error_message)
+        if on_result:
+            on_result(index, image_bytes, error_message)
+
+    def unfinished():
+        return [prompt_id for prompt_id, index in prompt_ids.items() if results[index] is None]
+
+    def fail_all(error_message):
+        for index in range(len(results)):
+            finish(index, None, error_message)
+        return results
 
     # === 先連接 WebSocket(在提交之前)===
-    uri = f"ws://{server_address}/ws?clientId={CLIENT_ID}"
-    print(f"[DEBUG] 連線到 WebSocket → {uri}")
+    uri = f"ws://{server_address}/ws?clientId={client_id}"
+    logger.debug("連線到 WebSocket → %s", uri)
+    mark_job_state(job_state, 'submit')
 
     try:
-        async with websockets.connect(uri) as websocket:
+        async with websockets.connect(uri, open_timeout=timeouts['submit']) as websocket:
             # === 連接後再提交任務 ===
             submit_url = f"http://{server_address}/prompt"
-            print(f"[DEBUG] 使用 HTTP POST 提交 prompt → {submit_url}")
+            logger.debug("使用 HTTP POST 提交 %d 個 prompt → %s", len(prompt_workflows), submit_url)
             
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(submit_url, json=payload) as resp:
-                        if resp.status != 200:
-                            return None, f"ComfyUI 回傳錯誤狀態碼:{resp.status}"
-                        response_data = await resp.json()
-                        prompt_id = response_data.get("prompt_id")
-                        print(f"[DEBUG] Prompt 已成功提交,prompt_id: {prompt_id}")
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeouts['submit'])) as session:
+                    for index, prompt_workflow in enumerate(prompt_workflows):
+                        payload = {"prompt": prompt_workflow, "client_id": client_id}
+                        async with session.post(submit_url, json=payload) as resp:
+                            if resp.status != 200:
+                                finish(index, None, f"ComfyUI 回傳錯誤狀態碼:{resp.status}")
+                                continue
+                            response_data = await resp.json()
+                            prompt_id = response_data.get("prompt_id")
+                            prompt_ids[prompt_id] = index
+                            job_state['prompt_id'] = prompt_id
+                            job_state.setdefault('prompt_ids', []).append(prompt_id)
+                            bind_log_context(prompt_id=prompt_id)
+                            logger.info("Prompt 已成功提交")
+            except asyncio.TimeoutError:
+                error_message = f"逾時:提交 prompt 超過 {timeouts['submit']} 秒"
+                if not prompt_ids:
+                    return fail_all(error_message)
+                for index in set(range(len(results))) - set(prompt_ids.values()):
+                    finish(index, None, error_message)
             except Exception as e:
-                return None, f"錯誤:無法送出 prompt → {e}"
+                error_message = f"錯誤:無法送出 prompt → {e}"
+                if not prompt_ids:
+                    return fail_all(error_message)
+                for index in set(range(len(results))) - set(prompt_ids.values()):
+                    finish(index, None, error_message)
 
             # === 監聽 WebSocket 回應 ===
+            total_deadline = time.monotonic() + timeouts['total'] * max(len(prompt_ids), 1)
+            mark_job_state(job_state, 'queued')
+            current_index = None
             current_node_title = ""
             last_node_title = None
-
-            while True:
-                msg = await websocket.recv()
-                if isinstance(msg, str):
-                    data = json.loads(msg)
-                    msg_type = data.get("type")
-
-                    # 處理 status 事件
-                    if msg_type == "status":
-                        status_data = data.get("data", {})
-                        print(f"[DEBUG] 收到 status 事件: {status_data}")
-                        continue
-
-                    elif msg_type == "execution_start":
-                        print("ComfyUI 任務開始執行。")
-
-                    elif msg_type == "executing":
-                        node_id = data["data"].get("node")
+            last_event_at = time.monotonic()
+            first_event_seen = False
+
+            while unfinished():
+                # 尚未開始執行時套用 first_event 期限,之後套用 idle 期限,兩者都不可超過 total
+                window = timeouts['idle'] if first_event_seen else timeouts['first_event']
+                deadline = min(last_event_at + window, total_deadline)
+                try:
+                    msg = await asyncio.wait_for(websocket.recv(), timeout=max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    if time.monotonic() >= total_deadline:
+                        reason = f"任務總執行時間超過 {timeouts['total']} 秒"
+                    elif not first_event_seen:
+                        reason = f"提交後 {timeouts['first_event']} 秒內未開始執行"
+                    else:
+                        reason = f"超過 {timeouts['idle']} 秒沒有任何進度"
+                    logger.error("%s,取消 prompt", reason)
+                    for prompt_id in unfinished():
+                        await cancel_prompt(prompt_id, server_address)
+                    return fail_all(f"逾時:{reason}")
+
+                if not isinstance(msg, str):
+                    continue
+
+                data = json.loads(msg)
+                msg_type = data.get("type")
+                event_data = data.get("data") or {}
+
+                # 忽略其他 prompt 的事件,避免它們重置本任務的期限
+                event_prompt_id = event_data.get("prompt_id")
+                if event_prompt_id and event_prompt_id not in prompt_ids:
+                    continue
+                index = prompt_ids.get(event_prompt_id, current_index)
+
+                # 處理 status 事件
+                if msg_type == "status":
+                    logger.debug("收到 status 事件: %s", event_data)
+                    continue
+
+                first_event_seen = True
+                mark_job_state(job_state, 'running')
+
+                if msg_type == "execution_start":
+                    current_index = index
+                    bind_log_context(prompt_id=event_prompt_id)
+                    logger.info("ComfyUI 任務開始執行")
+
+                elif msg_type == "executing":
+                    node_id = event_data.get("node")
+                    
+                    # node 為 None 表示執行結束;輸出節點全部命中快取時不會有 executed 事件,改從 /history 取得結果
+                    if node_id is None:
+                        if event_prompt_id in prompt_ids and results[index] is None:
+                            logger.debug("收到 executing 事件,node=None,執行已結束,從 /history 取得輸出")
+                            finish(index, *await recover_from_history(event_prompt_id, server_address, total_deadline, job_state, timeouts['idle']))
+                        else:
+                            logger.debug("收到 executing 事件,node=None,執行可能已結束")
                         
-                        # node 為 None 表示執行結束
-                        if node_id is None:
-                            print("\n[DEBUG] 收到 executing 事件,node=None,執行可能已結束")
-                            continue
-                            
+                    else:
                         current_node_title = node_titles.get(node_id, f"Node {node_id}")
                         if current_node_title != last_node_title:
-                            print(f"\n正在執行節點: {current_node_title}")
+                            logger.debug("正在執行節點: %s", current_node_title)
                             last_node_title = current_node_title
 
-                    elif msg_type == "progress":
-                        d = data["data"]
-                        print_progress_bar(
-                            d["value"],
-                            d["max"],
-                            prefix=f"{current_node_title}",
-                            suffix="完成"
+                elif msg_type == "progress":
+                    # 每個取樣步數都會觸發,預設不記錄,或依 PROGRESS_LOG_EVERY 取樣
+                    every = log.PROGRESS_LOG_EVERY
+                    if every and (event_data["value"] % every == 0 or event_data["value"] >= event_data["max"]):
+                        logger.info("%s 進度 %d/%d", current_node_title, event_data["value"], event_data["max"])
+
+                elif msg_type == "executed":
+                    node_id = event_data.get("node")
+                    output_data = event_data.get("output", {})
+                    
+                    logger.debug("節點 %s 執行完成", node_titles.get(node_id, node_id))
+                    
+                    # 檢查是否有圖片輸出
+                    if "images" in output_data and index is not None and results[index] is None:
+                        logger.info("圖片生成完畢,正在下載")
+                        mark_job_state(job_state, 'download')
+                        img_info = output_data["images"][0]
+                        img_bytes = await fetch_image(
+                            img_info["filename"], 
+                            img_info.get("subfolder", ""), 
+                            img_info.get("type", "output"),
+                            server_address,
+                            timeouts['idle']
                         )
+                        if img_bytes:
+                            logger.info("任務結束")
+                            finish(index, img_bytes, None)
+                        else:
+                            finish(index, None, "無法下載生成的圖片")
+
+                elif msg_type == "execution_error":
+                    logger.error("ComfyUI 執行錯誤:%s", event_data)
+                    if index is not None:
+                        finish(index, None, f"ComfyUI 執行錯誤:{event_data}")
+
+                elif msg_type == "execution_cached":
+                    cached_nodes = event_data.get("nodes", [])
+                    job_state['cached_nodes'] += len(cached_nodes)
+                    if index is not None:
+                        job_state['prompt_cached'][index] += len(cached_nodes)
+                    logger.debug("%d 個節點使用快取", len(cached_nodes))
 
-                    elif msg_type == "executed":
-                        node_id = data["data"].get("node")
-                        output_data = data["data"].get("output", {})
-                        
-                        print(f"\n[DEBUG] 節點 {node_titles.get(node_id, node_id)} 執行完成")
-                        
-                        # 檢查是否有圖片輸出
-                        if "images" in output_data:
-                            print("\n圖片生成完畢!正在下載...")
-                            img_info = output_data["images"][0]
-                            img_bytes = await fetch_image(
-                                img_info["filename"], 
-                                img_info.get("subfolder", ""), 
-                                img_info.get("type", "output"),
-                                server_address
-                            )
-                            if img_bytes:
-                                print("--- 任務結束 ---")
-                                return img_bytes, None
-                            else:
-                                return None, "無法下載生成的圖片"
-
-                    elif msg_type == "execution_error":
-                        error_data = data.get("data", {})
-                        print(f"[錯誤] ComfyUI 執行錯誤:{error_data}")
-                        return None, f"ComfyUI 執行錯誤:{error_data}"
-
-                    elif msg_type == "execution_cached":
-                        print(f"[DEBUG] 某些節點使用快取")
+                else:
+                    logger.debug("收到其他事件類型:%s", msg_type)
+
+                # 下載圖片也算在處理時間內,處理完才重新計算 idle 期限
+                last_event_at = time.monotonic()
+
+            return fail_all("未知錯誤")
+
+    except (websockets.exceptions.ConnectionClosed, ConnectionError) as e:
+        pending = unfinished()
+        if not pending:
+            return fail_all(f"WebSocket 連接關閉:{e}")
+        # prompt 仍在 ComfyUI 上執行,改用 /history 輪詢取回結果,避免浪費已花費的 GPU 時間
+        logger.warning("WebSocket 連接中斷(%s),改以 /history 輪詢 %d 個 prompt", e, len(pending))
+        recovered = await asyncio.gather(*(
+            recover_from_history(prompt_id, server_address, total_deadline, job_state, timeouts['idle'])
+            for prompt_id in pending
+        ))
+        for prompt_id, (image_bytes, error_message) in zip(pending, recovered):
+            finish(prompt_ids[prompt_id], image_bytes, error_message)
+        return fail_all(f"WebSocket 連接關閉:{e}")
+    except asyncio.TimeoutError:
+        return fail_all(f"逾時:連線 WebSocket 超過 {timeouts['submit']} 秒")
+    except asyncio.CancelledError:
+        # 被看門狗或關機取消時,一併取消 ComfyUI 上的 prompt,避免浪費 GPU
+        await asyncio.shield(asyncio.gather(*(
+            cancel_prompt(prompt_id, server_address) for prompt_id in unfinished()
+        )))
+        raise
+    except Exception as e:
+        return fail_all(f"WebSocket 錯誤:{e}")
+
+
+# --- 透過 /history 輪詢取回結果 ---
+async def recover_from_history(prompt_id, server_address, deadline, job_state, fetch_timeout=60):
+    mark_job_state(job_state, 'recovering')
+    delay = 1
+
+    while time.monotonic() < deadline:
+        entry = await fetch_history(prompt_id, server_address)
+        if entry is None:
+            logger.warning("無法連線到 %s,%s 秒後重試", server_address, delay)
+        else:
+            mark_job_state(job_state)
+            if not entry:
+                # 尚未出現在歷史紀錄:確認 prompt 是否仍在佇列中,或已隨 ComfyUI 重啟而遺失
+                queued = await is_prompt_queued(prompt_id, server_address)
+                if queued is False:
+                    entry = await fetch_history(prompt_id, server_address)
+                    if not entry:
+                        return None, f"prompt {prompt_id} 已不在 ComfyUI 佇列或歷史紀錄中"
+
+            if entry:
+                status = entry.get("status", {})
+                if status.get("status_str") == "error":
+                    messages = [m for m in status.get("messages", []) if m and m[0] == "execution_error"]
+                    error_data = messages[-1][1] if messages else status
+                    logger.error("ComfyUI 執行錯誤:%s", error_data)
+                    return None, f"ComfyUI 執行錯誤:{error_data}"
+
+                images = [
+                    img for output in entry.get("outputs", {}).values()
+                    for img in output.get("images", [])
+                ]
+                if images:
+                    logger.info("圖片生成完畢,正在下載")
+                    mark_job_state(job_state, 'download')
+                    img_info = images[0]
+                    img_bytes = await fetch_image(
+                        img_info["filename"],
+                        img_info.get("subfolder", ""),
+                        img_info.get("type", "output"),
+                        server_address,
+                        fetch_timeout
+                    )
+                    if img_bytes:
+                        logger.info("任務結束")
+                        return img_bytes, None
+                    return None, "無法下載生成的圖片"
+
+                if status.get("completed"):
+                    return None, "ComfyUI 執行完畢,但沒有任何圖片輸出"
+
+        await asyncio.sleep(max(min(delay, deadline - time.monotonic()), 0))
+        delay = min(delay * 2, 15)
+
+    await cancel_prompt(prompt_id, server_address)
+    return None, f"逾時:WebSocket 中斷後等待 prompt {prompt_id} 完成超時"
+
+
+async def fetch_history(prompt_id, server_address, timeout=10):
+    """取得 prompt 的歷史紀錄;尚未完成時返回 {},無法連線時返回 None"""
+    url = f"http://{server_address}/history/{prompt_id}"
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    return None
+                data = await resp.json()
+                return data.get(prompt_id, {})
+    except Exception:
+        return None
 
-                    else:
-                        print(f"[DEBUG] 收到其他事件類型:{msg_type}")
 
-    except websockets.exceptions.ConnectionClosed as e:
-        return None, f"WebSocket 連接關閉:{e}"
+async def is_prompt_queued(prompt_id, server_address, timeout=10):
+    """檢查 prompt 是否仍在等待或執行中;無法連線時返回 None"""
+    url = f"http://{server_address}/queue"
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    return None
+                data = await resp.json()
+    except Exception:
+        return None
+    items = data.get("queue_running", []) + data.get("queue_pending", [])
+    return any(len(item) > 1 and item[1] == prompt_id for item in items)
+
+
+# --- 取消 ComfyUI 上的 prompt ---
+async def cancel_prompt(prompt_id, server_address, timeout=5):
+    if not prompt_id:
+        return
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            # 若仍在等待中則從佇列移除,若正在執行則中斷
+            async with session.post(f"http://{server_address}/queue", json={"delete": [prompt_id]}):
+                pass
+            async with session.post(f"http://{server_address}/interrupt", json={"prompt_id": prompt_id}):
+                pass
+        logger.info("已取消 prompt %s", prompt_id)
     except Exception as e:
-        return None, f"WebSocket 錯誤:{e}"
+        logger.error("取消 prompt %s 失敗: %s", prompt_id, e)
 
 
+# --- 後端健康檢查 ---
+async def check_backend_health(server_address, timeout=5):
+    url = f"http://{server_address}/system_stats"
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.get(url) as resp:
+                return resp.status == 200
+    except Exception:
+        return False
+
 
 # --- 下載生成圖片 ---
-async def fetch_image(filename, subfolder, file_type, server_address):
+async def fetch_image(filename, subfolder, file_type, server_address, timeout=60):
     params = {"filename": filename, "type": file_type}
     if subfolder:
         params["subfolder"] = subfolder
@@ -329,16 +772,16 @@ async def fetch_image(filename, subfolder, file_type, server_address):
     query_string = urllib.parse.urlencode(params)
     url = f"http://{server_address}/view?{query_string}"
     
-    print(f"[DEBUG] 下載圖片：{url}")
+    logger.debug("下載圖片：%s", url)
     
     try:
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
             async with session.get(url) as resp:
                 if resp.status == 200:
                     return await resp.read()
                 else:
-                    print(f"[錯誤] 下載圖片失敗，狀態碼：{resp.status}")
+                    logger.error("下載圖片失敗，狀態碼：%s", resp.status)
                     return None
     except Exception as e:
-        print(f"[錯誤] 下載圖片時發生例外：{e}")
+        logger.error("下載圖片時發生例外：%s", e)
         return None
\ No newline at end of file
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from api import check_backend_health
+
+logger = logging.getLogger(__name__)
+
+
+# --- 單一後端狀態 ---
+class Backend:
+    def __init__(self, address):
+        self.address = address
+        self.healthy = True
+        self.failures = deque()      # 最近失敗的時間戳記
+        self.open_until = 0.0        # 斷路器開啟(暫停使用)直到此時間
+        self.trips = 0               # 連續跳脫次數,用於延長冷卻時間
+        self.last_used = 0.0
+        self.first_request_pending = True  # 啟動或恢復後尚未處理過使用者請求
+
+    @property
+    def circuit_open(self):
+        return time.monotonic() < self.open_until
+
+    def is_available(self):
+        return self.healthy and not self.circuit_open
+
+    def describe(self):
+        if not self.healthy:
+            return f"{self.address} (離線)"
+        if self.circuit_open:
+            remaining = int(self.open_until - time.monotonic())
+            return f"{self.address} (暫停 {remaining}s)"
+        return f"{self.address} (正常)"
+
+
+# --- 後端池(含斷路器)---
+class BackendPool:
+    def __init__(self, addresses, failure_threshold=3, failure_window=300, cooldown=120, max_cooldown=1800):
+        self.backends = [Backend(address) for address in addresses]
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.on_recovered = []  # 後端恢復在線時呼叫的 callback(backend)
+
+    def __len__(self):
+        return len(self.backends)
+
+    def pick(self, exclude=(), only=None, prefer=None):
+        """
+        挑選可用的後端,優先選擇未嘗試過且最久未使用的;only 限制可選的位址。
+        prefer 可用且未嘗試過時直接選它(例如保有上一個任務節點快取的後端)
+        """
+        candidates = [b for b in self.backends if b.is_available() and (only is None or b.address in only)]
+        if not candidates:
+            return None
+        preferred = [b for b in candidates if b.address not in exclude]
+        cached = [b for b in preferred if b.address == prefer]
+        backend = cached[0] if cached else min(preferred or candidates, key=lambda b: b.last_used)
+        backend.last_used = time.monotonic()
+        return backend
+
+    async def wait_for_backend(self, exclude=(), timeout=60, only=None, prefer=None):
+        """等待直到有可用後端,逾時則返回 None"""
+        deadline = time.monotonic() + timeout
+        while True:
+            backend = self.pick(exclude, only, prefer)
+            if backend or time.monotonic() >= deadline:
+                return backend
+            await asyncio.sleep(1)
+
+    def record_success(self, backend):
+        backend.failures.clear()
+        backend.trips = 0
+
+    def record_failure(self, backend, reason=""):
+        now = time.monotonic()
+        backend.failures.append(now)
+        while backend.failures and now - backend.failures[0] > self.failure_window:
+            backend.failures.popleft()
+
+        if len(backend.failures) >= self.failure_threshold:
+            # 冷卻時間隨連續跳脫次數加倍,避免反覆不穩的後端很快又被選中
+            cooldown = min(self.cooldown * (2 ** backend.trips), self.max_cooldown)
+            backend.open_until = now + cooldown
+            backend.trips += 1
+            backend.failures.clear()
+            logger.warning("[後端] %s 短時間內失敗過多,暫停使用 %d 秒(原因: %s)", backend.address, cooldown, reason)
+
+    async def health_loop(self, interval=30, timeout=5):
+        """背景任務:定期檢查所有後端是否在線"""
+        while True:
+            results = await asyncio.gather(
+                *(check_backend_health(b.address, timeout) for b in self.backends)
+            )
+            for backend, healthy in zip(self.backends, results):
+                recovered = healthy and not backend.healthy
+                if healthy != backend.healthy:
+                    state = "恢復在線" if healthy else "無法連線"
+                    logger.warning("[後端] %s %s", backend.address, state)
+                backend.healthy = healthy
+                if recovered:
+                    backend.first_request_pending = True
+                    for callback in self.on_recovered:
+                        callback(backend)
+            await asyncio.sleep(interval)
+
+    def any_available(self, only=None):
+        return any(b.is_available() for b in self.backends if only is None or b.address in only)
+
+    def status_text(self):
+        return " | ".join(b.describe() for b in self.backends)
@@ -3,18 +3,104 @@ from discord.ext import commands
 from discord import app_commands
 import io
 import os
+import re
+import zipfile
+import itertools
+import math
 import json
 import asyncio
+import time
+import uuid
+import logging
 from dotenv import load_dotenv
-from api import get_image_txt2img, get_image_img2img
+from api import encode_png, get_image_txt2img, get_image_img2img, get_images_txt2img_batch, get_images_img2img_batch, warm_up_backend, new_seed, scaled_size, template_checkpoint, mark_job_state, DEFAULT_TIMEOUTS, DRAFT_STEPS, DRAFT_SCALE
+from backends import BackendPool
+from log import setup_logging, bind_log_context
+from grid import build_contact_sheet, save_originals, load_original
+from history import JobHistory, throughput_summary, top_consumers, since_hours
 from collections import deque
 from datetime import datetime
 
 # --- 設定 ---
 load_dotenv()
+
+# --- 日誌 ---
+# PROGRESS_LOG_EVERY:每隔幾個取樣步數記錄一次進度,0 為不記錄
+setup_logging(
+    os.getenv("LOG_LEVEL", "INFO"),
+    os.getenv("LOG_FILE"),
+    int(os.getenv("PROGRESS_LOG_EVERY", 0)),
+)
+logger = logging.getLogger("bot")
+
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 COMFYUI_SERVER_ADDRESS = os.getenv("COMFYUI_SERVER_ADDRESS")
+# 可用逗號分隔多個 ComfyUI 後端,失敗時會自動切換
+COMFYUI_SERVER_ADDRESSES = [a.strip() for a in (COMFYUI_SERVER_ADDRESS or "").split(",") if a.strip()]
 PROMPTS_FILE = "user_prompts.json"
+DRAFTS_FILE = "draft_jobs.json"
+HISTORY_FILE = os.getenv("HISTORY_FILE", "job_history.jsonl")
+# 任務紀錄在背景批次寫入的間隔(秒)
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 5))
+
+# 草稿模式
+DRAFT_STEPS = int(os.getenv("DRAFT_STEPS", DRAFT_STEPS))
+DRAFT_SCALE = float(os.getenv("DRAFT_SCALE", DRAFT_SCALE))
+REFINE_UPSCALE_DENOISE = float(os.getenv("REFINE_UPSCALE_DENOISE", 0.45))
+MAX_STORED_DRAFTS = 500
+TEMPLATE_STEPS = 30  # 工作流程模板的預設取樣步數,用於估算草稿成本
+
+# 總覽圖模式:多張結果合成一張縮圖總覽,原圖存在本機供「原圖」按鈕取用
+GRID_CACHE_DIR = os.getenv("GRID_CACHE_DIR", "grid_cache")
+GRID_CACHE_MAX_FILES = int(os.getenv("GRID_CACHE_MAX_FILES", 400))
+
+# 佇列上限(請求數、預估 GPU 秒數、暫存的輸入圖片位元組)
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", 20))
+MAX_QUEUE_GPU_SECONDS = float(os.getenv("MAX_QUEUE_GPU_SECONDS", 1800))
+MAX_QUEUE_BYTES = int(os.getenv("MAX_QUEUE_BYTES", 64 * 1024 * 1024))
+# 一張完整品質 vertical 圖片的預估秒數,之後會依實際執行時間自動修正
+ESTIMATED_SECONDS_PER_IMAGE = float(os.getenv("ESTIMATED_SECONDS_PER_IMAGE", 20))
+# Discord interaction token 有效 15 分鐘,過期後無法再送出結果
+INTERACTION_TOKEN_LIFETIME = 15 * 60
+INTERACTION_TOKEN_MARGIN = 30
+
+# 快取排程:在前 N 個等待中的請求內,優先執行與上一個任務共用提示詞/checkpoint/尺寸的請求,
+# 讓 ComfyUI 跳過 CLIP 編碼與模型載入;每個請求最多被插隊 N 次。設為 0 停用
+CACHE_REORDER_WINDOW = int(os.getenv("CACHE_REORDER_WINDOW", 0))
+
+# 多線道排程:預估秒數不超過 FAST_LANE_MAX_SECONDS 的小型任務走快速線道(0 為停用),
+# 管理員或 PRIORITY_ROLE_IDS 身分組走優先線道;任何線道等待超過 LANE_STARVATION_SECONDS 時最久的先執行
+FAST_LANE_MAX_SECONDS = float(os.getenv("FAST_LANE_MAX_SECONDS", 10))
+PRIORITY_ROLE_IDS = {int(r) for r in os.getenv("PRIORITY_ROLE_IDS", "").split(",") if r.strip()}
+LANE_STARVATION_SECONDS = float(os.getenv("LANE_STARVATION_SECONDS", 300))
+# 保留給快速線道的後端(逗號分隔,須包含在 COMFYUI_SERVER_ADDRESS 中),由獨立的 worker 處理
+FAST_LANE_BACKENDS = [a.strip() for a in os.getenv("FAST_LANE_BACKENDS", "").split(",") if a.strip()]
+
+# 預熱:啟動時與後端恢復在線時提交最小工作流程,讓模型常駐記憶體
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# 後端閒置超過此秒數時重新預熱,避免模型被卸載;設為 0 停用
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", 0))
+
+# 各階段逾時(秒),未設定則使用 api.DEFAULT_TIMEOUTS
+JOB_TIMEOUTS = {
+    'upload': float(os.getenv("COMFYUI_UPLOAD_TIMEOUT", DEFAULT_TIMEOUTS['upload'])),
+    'submit': float(os.getenv("COMFYUI_SUBMIT_TIMEOUT", DEFAULT_TIMEOUTS['submit'])),
+    'first_event': float(os.getenv("COMFYUI_FIRST_EVENT_TIMEOUT", DEFAULT_TIMEOUTS['first_event'])),
+    'idle': float(os.getenv("COMFYUI_IDLE_TIMEOUT", DEFAULT_TIMEOUTS['idle'])),
+    'total': float(os.getenv("COMFYUI_TOTAL_TIMEOUT", DEFAULT_TIMEOUTS['total'])),
+}
+
+# 失敗重試與斷路器
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+BACKEND_WAIT_TIMEOUT = float(os.getenv("BACKEND_WAIT_TIMEOUT", 60))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 3))
+BREAKER_FAILURE_WINDOW = float(os.getenv("BREAKER_FAILURE_WINDOW", 300))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 120))
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 30))
+
+# 看門狗:任務超過所有階段期限仍無動靜時強制終止
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", 10))
+WATCHDOG_GRACE = float(os.getenv("WATCHDOG_GRACE", 30))
 
 # --- 提示詞檔案處理---
 def load_prompts(file_path):
@@ -25,7 +111,7 @@ def load_prompts(file_path):
             data = json.load(f)
             return {int(k): v for k, v in data.items()}
     except (json.JSONDecodeError, IOError) as e:
-        print(f"[提示詞] 載入 {file_path} 失敗: {e}，將使用空設定")
+        logger.warning("[提示詞] 載入 %s 失敗: %s，將使用空設定", file_path, e)
         return {}
 
 def _save_prompts_sync(file_path, data):
@@ -36,13 +122,48 @@ async def save_prompts(file_path, data):
     loop = asyncio.get_event_loop()
     try:
         await loop.run_in_executor(None, _save_prompts_sync, file_path, data)
-        print(f"[提示詞] 已成功儲存提示詞到 {file_path}")
+        logger.info("[提示詞] 已成功儲存提示詞到 %s", file_path)
     except Exception as e:
-        print(f"[提示詞] 儲存提示詞失敗: {e}")
+        logger.error("[提示詞] 儲存提示詞失敗: %s", e)
 
 # 用於儲存每個使用者的提示詞
 user_prompts = load_prompts(PROMPTS_FILE)
 
+# --- 草稿紀錄檔案處理(供精修按鈕在重啟後使用)---
+def load_drafts(file_path):
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            return {int(k): v for k, v in data.items()}
+    except (json.JSONDecodeError, IOError) as e:
+        logger.warning("[草稿] 載入 %s 失敗: %s，將使用空紀錄", file_path, e)
+        return {}
+
+async def remember_draft(message_id, request, seeds, positives=None):
+    draft_jobs[message_id] = {
+        'user_id': request.user_id,
+        'positive': request.positive,
+        'positives': positives,  # 提示詞變體時每張圖各自的正向提示詞
+        'negative': request.negative,
+        'size': request.size,
+        'mode': request.mode,
+        'seeds': seeds,
+    }
+    # 只保留最近的草稿,避免檔案無限增長
+    while len(draft_jobs) > MAX_STORED_DRAFTS:
+        draft_jobs.pop(next(iter(draft_jobs)))
+
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, _save_prompts_sync, DRAFTS_FILE, dict(draft_jobs))
+    except Exception as e:
+        logger.error("[草稿] 儲存草稿紀錄失敗: %s", e)
+
+# 以結果訊息 ID 為鍵的草稿參數
+draft_jobs = load_drafts(DRAFTS_FILE)
+
 # 圖片尺寸選項
 IMAGE_SIZES = {
     'square': (1024, 1024),
@@ -55,50 +176,512 @@ DEFAULT_POSITIVE_PROMPT = """Hatsune Miku,limited palette,black background,color
 DEFAULT_NEGATIVE_PROMPT = """worst quality,bad quality,bad hands,very displeasing,extra digit,fewer digits,jpeg artifacts,signature,username,reference,mutated,lineup,manga,comic,disembodied,futanari,yaoi,dickgirl,turnaround,2koma,4koma,monster,cropped,amputee,text,bad foreshortening,what,guro,logo,bad anatomy,bad perspective,bad proportions,artistic error,anatomical nonsense,amateur,out of frame,multiple views,"""
 
 MAX_BATCH_SIZE = 4 
+# 批次圖生圖一次最多處理的輸入圖片數(附件或壓縮檔內的圖片)
+MAX_BATCH_INPUTS = int(os.getenv("MAX_BATCH_INPUTS", 16))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+# 提示詞變體一次最多展開的數量(Discord 一則訊息最多 10 個附件)
+MAX_PROMPT_VARIANTS = min(int(os.getenv("MAX_PROMPT_VARIANTS", 8)), 10)
+
+# --- 佇列請求 ---
+class GenerationRequest:
+    """佇列中的請求,只保留 worker 需要的欄位(不保存整個 Interaction)"""
+    __slots__ = (
+        'request_id', 'followup', 'user_id', 'user_name', 'user_mention', 'guild_id', 'expires_at', 'enqueued_at',
+        'positive', 'negative', 'batch_count', 'size', 'mode', 'input_image', 'input_images',
+        'denoise', 'draft', 'grid', 'prompts', 'seeds', 'units', 'job_state', 'cache_key', 'skipped',
+        'lane', 'allowed_backends', 'preferred_backend',
+    )
+
+    def __init__(self, interaction, positive, negative, batch_count, size, mode='txt2img', input_image=None, denoise=0.75, draft=False, seeds=None, input_images=None, grid=False, prompts=None):
+        self.request_id = uuid.uuid4().hex[:8]
+        self.followup = interaction.followup
+        self.user_id = interaction.user.id
+        self.user_name = interaction.user.display_name
+        self.user_mention = interaction.user.mention
+        self.guild_id = interaction.guild_id
+        self.enqueued_at = time.monotonic()
+        # interaction token 過期後就無法再回覆或編輯訊息
+        age = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        self.expires_at = time.monotonic() + INTERACTION_TOKEN_LIFETIME - INTERACTION_TOKEN_MARGIN - age
+        self.positive = positive
+        self.negative = negative
+        self.batch_count = batch_count
+        self.size = size
+        self.mode = mode
+        self.input_image = input_image
+        self.input_images = input_images  # 批次圖生圖的所有輸入圖片
+        self.denoise = denoise
+        self.draft = draft
+        self.grid = grid
+        self.prompts = prompts  # 提示詞變體展開後的每個正向提示詞
+        self.seeds = seeds
+        self.units = estimate_units(batch_count, size, draft)
+        self.job_state = None
+        # 這些輸入相同時,ComfyUI 可重用上一個 prompt 的節點快取
+        self.cache_key = (positive, negative, template_checkpoint(mode), size, draft)
+        self.skipped = 0  # 被快取排程插隊的次數
+        self.lane = 'normal'
+        self.allowed_backends = None  # 由執行的 worker 設定,None 表示可使用所有後端
+        self.preferred_backend = None  # 與上一個任務共用快取時,優先送到執行上一個任務的後端
+
+    @property
+    def nbytes(self):
+        nbytes = len(self.input_image) if self.input_image else 0
+        return nbytes + sum(len(image) for image in self.input_images or ())
+
+
+def estimate_units(batch_count, size, draft=False):
+    """以「一張完整品質的 vertical 圖片」為單位估算 GPU 工作量"""
+    width, height = scaled_size(size, DRAFT_SCALE if draft else 1.0)
+    ref_width, ref_height = IMAGE_SIZES['vertical']
+    units = batch_count * (width * height) / (ref_width * ref_height)
+    if draft:
+        units *= DRAFT_STEPS / TEMPLATE_STEPS
+    return units
+
+
+def format_duration(seconds):
+    seconds = int(max(seconds, 0))
+    if seconds >= 60:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds} 秒"
+
+
+VARIANT_PATTERN = re.compile(r"\{([^{}]*\|[^{}]*)\}")
+# 展開前先檢查組合數,避免 {|}{|}... 這類只產生空白或重複結果的輸入讓展開卡住事件迴圈
+VARIANT_MAX_GROUPS = 8  # 每行最多的 {} 數
+VARIANT_MAX_COMBINATIONS = 100  # 所有行合計最多走訪的組合數
+
+
+def expand_prompt_variants(text, limit):
+    """
+    每個非空白行是一個提示詞,行內的 {a|b|c} 會展開成所有組合。
+    返回去除重複後的提示詞列表,超過 limit 個時拋出 ValueError
+    """
+    prompts = []
+    visited = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        parts = VARIANT_PATTERN.split(line)
+        if len(parts) // 2 > VARIANT_MAX_GROUPS:
+            raise ValueError(f"每行最多 {VARIANT_MAX_GROUPS} 組 {{}},請減少變體")
+        # split 後奇數位置是 {} 內的選項
+        choices = [part.split('|') if i % 2 else [part] for i, part in enumerate(parts)]
+        combinations = math.prod(len(options) for options in choices)
+        visited += combinations
+        if combinations > limit:
+            raise ValueError(f"展開後超過 {limit} 個提示詞,請減少變體")
+        if visited > VARIANT_MAX_COMBINATIONS:
+            raise ValueError("提示詞行數或重複組合過多,請減少變體")
+        for combination in itertools.product(*choices):
+            prompt = ''.join(combination).strip()
+            if prompt and prompt not in prompts:
+                prompts.append(prompt)
+            if len(prompts) > limit:
+                raise ValueError(f"展開後超過 {limit} 個提示詞,請減少變體")
+    if not prompts:
+        raise ValueError("請至少輸入一個提示詞")
+    return prompts
+
+
+def extract_archive_images(data, max_count, max_bytes):
+    """
+    從 zip 壓縮檔取出圖片(依檔名排序),返回 [(檔名, bytes), ...];
+    超過張數或總大小上限時拋出 ValueError。
+    實際讀取時也限制大小,不信任壓縮檔標頭記錄的檔案大小
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        raise ValueError("無法讀取壓縮檔,請上傳 zip 格式")
+
+    with archive:
+        entries = sorted(
+            (info for info in archive.infolist()
+             if not info.is_dir()
+             and not info.filename.startswith('__MACOSX/')
+             and info.filename.lower().endswith(IMAGE_EXTENSIONS)),
+            key=lambda info: info.filename
+        )
+        if not entries:
+            raise ValueError("壓縮檔中沒有圖片")
+        if len(entries) > max_count:
+            raise ValueError(f"壓縮檔中有 {len(entries)} 張圖片,超過上限 {max_count} 張")
+
+        images = []
+        remaining = max_bytes
+        for info in entries:
+            if info.file_size > remaining:
+                raise ValueError("壓縮檔解壓後過大")
+            with archive.open(info) as f:
+                image_bytes = f.read(remaining + 1)
+            if len(image_bytes) > remaining:
+                raise ValueError("壓縮檔解壓後過大")
+            remaining -= len(image_bytes)
+            images.append((info.filename, image_bytes))
+        return images
+
+
+def encode_input_images(named_images):
+    """
+    把每張輸入圖片轉成 PNG(在執行緒中執行);
+    返回 (成功的 bytes 列表, 無法解碼的檔名列表)
+    """
+    images = []
+    failed = []
+    for name, image_bytes in named_images:
+        try:
+            images.append(encode_png(image_bytes))
+        except Exception as e:
+            logger.info("[批次圖生圖] 無法解碼 %s: %s", name, e)
+            failed.append(name)
+    return images, failed
+
+
+# --- 佇列 worker ---
+class QueueWorker:
+    """從指定的線道取出請求執行;backends 為 None 時可使用所有後端"""
+    def __init__(self, name, lanes, backends=None):
+        self.name = name
+        self.lanes = lanes
+        self.backends = backends
+        self.current_task = None
+        self.current_job = None  # 執行 current_task 的 asyncio.Task,供看門狗取消
+        self.last_cache_key = None
+        self.last_backend = None  # 執行上一個任務的後端,保有 last_cache_key 的節點快取
+
 
 # --- 佇列系統 ---
 class GenerationQueue:
-    def __init__(self):
-        self.queue = deque()
-        self.processing = False
-        self.current_task = None
-    
-    def add_request(self, interaction, positive, negative, batch_count, size, mode='txt2img', input_image=None, denoise=0.75):
-        request = {
-            'interaction': interaction,
-            'positive': positive,
-            'negative': negative,
-            'batch_count': batch_count,
-            'size': size,
-            'mode': mode,
-            'input_image': input_image,
-            'denoise': denoise,
-            'user_id': interaction.user.id,
-            'user_name': interaction.user.display_name
-        }
-        self.queue.append(request)
-        return len(self.queue)  # 返回佇列位置
+    # 依序服務的線道:管理員/指定身分組、小型任務、其他
+    LANES = ('priority', 'fast', 'normal')
+    LANE_NAMES = {'priority': '優先', 'fast': '快速', 'normal': '一般'}
+
+    def __init__(self, max_length=20, max_gpu_seconds=1800, max_bytes=64 * 1024 * 1024, seconds_per_unit=20, reorder_window=0, fast_lane_seconds=0, starvation_seconds=300, workers=None):
+        self.lanes = {lane: deque() for lane in self.LANES}
+        self.workers = workers or [QueueWorker("main", self.LANES)]
+        self.max_length = max_length
+        self.max_gpu_seconds = max_gpu_seconds
+        self.max_bytes = max_bytes
+        self.seconds_per_unit = seconds_per_unit  # 依實際執行時間持續修正
+        self.reorder_window = reorder_window
+        self.fast_lane_seconds = fast_lane_seconds
+        self.starvation_seconds = starvation_seconds
+
+    @property
+    def queue(self):
+        """所有等待中的請求,依線道順序排列"""
+        return [req for lane in self.LANES for req in self.lanes[lane]]
+
+    @property
+    def current_tasks(self):
+        return [worker.current_task for worker in self.workers if worker.current_task]
+
+    @property
+    def processing(self):
+        return bool(self.current_tasks)
+
+    def add_request(self, interaction, *args, **kwargs):
+        """加入請求;返回 (佇列位置, None),被拒絕時返回 (0, 原因)"""
+        request, rejection = self.prepare_request(interaction, *args, **kwargs)
+        if rejection:
+            return 0, rejection
+        return self.enqueue(request), None
+
+    def prepare_request(self, interaction, positive, negative, batch_count, size, mode='txt2img', input_image=None, denoise=0.75, draft=False, seeds=None, input_images=None, grid=False, prompts=None):
+        """
+        建立請求並檢查是否可以加入佇列(不加入);返回 (request, None),被拒絕時返回 (None, 原因)。
+        讓指令可以在 defer 之前就以 ephemeral 訊息拒絕
+        """
+        request = GenerationRequest(
+            interaction, positive, negative, batch_count, size,
+            mode, input_image, denoise, draft, seeds, input_images, grid, prompts
+        )
+        request.lane = self.assign_lane(interaction, request)
+        rejection = self.check_admission(request)
+        if rejection:
+            logger.info("[佇列系統] 拒絕 %s 的請求: %s", request.user_name, rejection)
+            return None, rejection
+        return request, None
+
+    def enqueue(self, request):
+        """把 prepare_request 建立的請求加入佇列;返回佇列位置"""
+        self.lanes[request.lane].append(request)
+        return self.lane_position(request.lane)
+
+    def assign_lane(self, interaction, request):
+        if has_priority(interaction):
+            return 'priority'
+        if self.estimate_seconds(request) <= self.fast_lane_seconds:
+            return 'fast'
+        return 'normal'
+
+    def lane_position(self, lane):
+        """線道最後一個請求的整體位置(前面線道的請求都會先處理)"""
+        lanes = self.LANES[:self.LANES.index(lane) + 1]
+        return sum(len(self.lanes[l]) for l in lanes)
+
+    def pop_next(self, worker):
+        """
+        依線道優先順序取出 worker 負責的下一個請求;
+        任何線道的第一個請求等待超過 starvation_seconds 時,最久的先執行
+        """
+        heads = [(lane, self.lanes[lane][0]) for lane in worker.lanes if self.lanes[lane]]
+        if not heads:
+            return None
+        if len(heads) > 1:
+            # 有其他線道可做時,把專屬 worker 能立即處理的線道留給它,兩邊同時執行
+            heads = [head for head in heads if not self.idle_dedicated_worker(head[0], worker)] or heads
+        lane = heads[0][0]
+        if self.starvation_seconds > 0:
+            now = time.monotonic()
+            starving = [(l, req) for l, req in heads if now - req.enqueued_at > self.starvation_seconds]
+            if starving:
+                starving_lane, oldest = min(starving, key=lambda head: head[1].enqueued_at)
+                if starving_lane != lane:
+                    logger.info("[佇列系統] %s 的請求 %s 已等待 %.0f 秒,優先執行", oldest.user_name, oldest.request_id, now - oldest.enqueued_at)
+                lane = starving_lane
+        return self.pop_from_lane(self.lanes[lane], worker)
+
+    def idle_dedicated_worker(self, lane, worker):
+        """是否有其他閒置、負責線道較少且後端可用的 worker 能處理此線道"""
+        return any(
+            other is not worker
+            and other.current_task is None
+            and lane in other.lanes
+            and len(other.lanes) < len(worker.lanes)
+            and backend_pool.any_available(other.backends)
+            for other in self.workers
+        )
+
+    def pop_from_lane(self, queue, worker):
+        """啟用快取排程時,在公平視窗內優先選擇與該 worker 上一個任務共用快取的請求"""
+        head = queue[0]
+        if (
+            self.reorder_window > 0
+            and worker.last_cache_key is not None
+            and head.cache_key != worker.last_cache_key
+            and head.skipped < self.reorder_window
+        ):
+            for idx in range(1, min(self.reorder_window + 1, len(queue))):
+                candidate = queue[idx]
+                if candidate.cache_key == worker.last_cache_key:
+                    # 被插隊的請求各記一次,達到上限後就不能再被插隊
+                    for req in list(queue)[:idx]:
+                        req.skipped += 1
+                    del queue[idx]
+                    generation_stats.reordered += 1
+                    logger.info("[佇列系統] 快取排程:%s 的請求 %s 提前執行(原位置 %d)", candidate.user_name, candidate.request_id, idx + 1)
+                    candidate.preferred_backend = worker.last_backend
+                    return candidate
+                if any(req.skipped >= self.reorder_window for req in list(queue)[:idx + 1]):
+                    break
+
+        request = queue.popleft()
+        if request.cache_key == worker.last_cache_key:
+            request.preferred_backend = worker.last_backend
+        worker.last_cache_key = request.cache_key
+        return request
+
+    def estimate_seconds(self, request):
+        return request.units * self.seconds_per_unit
+
+    def estimate_wait(self, lane=None):
+        """預估指定線道(含前面的線道)目前的請求全部處理完所需的秒數;未指定時為整個佇列"""
+        lanes = self.LANES if lane is None else self.LANES[:self.LANES.index(lane) + 1]
+        wait = sum(self.estimate_seconds(req) for l in lanes for req in self.lanes[l])
+
+        # 加上能處理此線道的 worker 中,最快空出來的那個還需要的時間
+        remaining = []
+        for worker in self.workers:
+            if lane is not None and lane not in worker.lanes:
+                continue
+            request = worker.current_task
+            if request and request.job_state:
+                elapsed = time.monotonic() - request.job_state['started_at']
+                remaining.append(max(self.estimate_seconds(request) - elapsed, 0))
+            else:
+                remaining.append(0)
+        return wait + min(remaining, default=0)
+
+    def check_admission(self, request):
+        cost = self.estimate_seconds(request)
+        if cost > self.max_gpu_seconds or request.nbytes > self.max_bytes:
+            return "請求過大,超過佇列可接受的上限,請減少數量或圖片大小"
+
+        def fits(count, total_cost, total_bytes):
+            return (
+                count < self.max_length
+                and total_cost + cost <= self.max_gpu_seconds
+                and total_bytes + request.nbytes <= self.max_bytes
+            )
+
+        queue = self.queue
+        count = len(queue)
+        total_cost = sum(self.estimate_seconds(req) for req in queue)
+        total_bytes = sum(req.nbytes for req in queue)
+        wait = self.estimate_wait()
+
+        if not fits(count, total_cost, total_bytes):
+            # 計算需要等前面多少請求完成,才能騰出足夠空間
+            retry_after = wait - total_cost
+            for req in queue:
+                retry_after += self.estimate_seconds(req)
+                count -= 1
+                total_cost -= self.estimate_seconds(req)
+                total_bytes -= req.nbytes
+                if fits(count, total_cost, total_bytes):
+                    break
+            return f"佇列已滿,請約 {format_duration(retry_after)} 後再試"
+
+        # 預估完成時 interaction 已過期,結果將無法送出(只計算會排在前面的線道)
+        finish_at = time.monotonic() + self.estimate_wait(request.lane) + cost
+        if finish_at > request.expires_at:
+            return f"目前等待時間過長,請約 {format_duration(finish_at - request.expires_at)} 後再試"
+        return None
+
+    def record_runtime(self, request, seconds):
+        """以實際執行時間修正每單位工作量的秒數(指數移動平均)"""
+        if request.units > 0:
+            self.seconds_per_unit = 0.8 * self.seconds_per_unit + 0.2 * (seconds / request.units)
+
+    def remove_user_requests(self, user_id):
+        removed = 0
+        for lane, queue in self.lanes.items():
+            self.lanes[lane] = deque(req for req in queue if req.user_id != user_id)
+            removed += len(queue) - len(self.lanes[lane])
+        return removed
     
     def get_queue_position(self, user_id):
         for idx, req in enumerate(self.queue):
-            if req['user_id'] == user_id:
+            if req.user_id == user_id:
                 return idx + 1
         return 0
+
+    def lane_depths(self):
+        return " / ".join(f"{self.LANE_NAMES[lane]} {len(self.lanes[lane])}" for lane in self.LANES)
     
     def get_queue_info(self):
-        if self.processing and self.current_task:
-            current_user = self.current_task.get('user_name', 'Unknown')
-            batch_info = self.current_task.get('batch_count', 1)
-            mode_info = '圖生圖' if self.current_task.get('mode') == 'img2img' else '文生圖'
-            waiting = len(self.queue)
-            return f"正在處理: {current_user} ({mode_info} x{batch_info}) | 等待中: {waiting} 個請求"
-        elif len(self.queue) > 0:
-            return f"等待中: {len(self.queue)} 個請求"
+        waiting = len(self.queue)
+        if self.processing:
+            running = []
+            for request in self.current_tasks:
+                mode_info = '圖生圖' if request.mode.startswith('img2img') else '文生圖'
+                if request.draft:
+                    mode_info += '草稿'
+                running.append(f"{request.user_name} ({mode_info} x{request.batch_count})")
+            return f"正在處理: {', '.join(running)} | 等待中: {waiting} 個請求 ({self.lane_depths()}) | 預估 {format_duration(self.estimate_wait())}"
+        elif waiting > 0:
+            return f"等待中: {waiting} 個請求 ({self.lane_depths()}) | 預估 {format_duration(self.estimate_wait())}"
         else:
             return "佇列空閒"
 
+
+def has_priority(interaction):
+    """管理員或擁有 PRIORITY_ROLE_IDS 中任一身分組的使用者走優先線道"""
+    permissions = getattr(interaction, 'permissions', None)
+    if permissions and permissions.manage_guild:
+        return True
+    roles = getattr(interaction.user, 'roles', ())
+    return any(role.id in PRIORITY_ROLE_IDS for role in roles)
+
+# --- 執行統計 ---
+class GenerationStats:
+    def __init__(self):
+        self.prompts = 0          # 成功完成的 ComfyUI prompt 數
+        self.prompts_with_hits = 0
+        self.cached_nodes = 0
+        self.total_nodes = 0
+        self.reordered = 0        # 被快取排程提前執行的請求數
+        self.warmups = 0
+        # 後端啟動/恢復後的第一個請求(可能包含模型載入)與其他請求分開統計
+        self.first_latencies = []
+        self.latencies = []
+
+    def record_latency(self, seconds, first_request=False):
+        latencies = self.first_latencies if first_request else self.latencies
+        latencies.append(seconds)
+        # 只保留最近的紀錄
+        if len(latencies) > 200:
+            del latencies[0]
+
+    def record_prompts(self, job_state, positions=(0,)):
+        """記錄這次嘗試中成功完成的 prompt(positions 為它們在提交順序中的位置)"""
+        prompt_nodes = job_state.get('prompt_nodes', [])
+        prompt_cached = job_state.get('prompt_cached', [])
+        for position in positions:
+            if position >= len(prompt_nodes):
+                continue
+            cached = prompt_cached[position]
+            self.prompts += 1
+            self.cached_nodes += cached
+            self.total_nodes += prompt_nodes[position]
+            if cached:
+                self.prompts_with_hits += 1
+
+    def summary(self):
+        if not self.prompts:
+            return "尚無統計資料"
+        node_rate = self.cached_nodes / self.total_nodes if self.total_nodes else 0
+        prompt_rate = self.prompts_with_hits / self.prompts
+        return (
+            f"已完成 prompt: {self.prompts}\n"
+            f"節點快取命中率: {node_rate:.1%} ({self.cached_nodes}/{self.total_nodes})\n"
+            f"有命中快取的 prompt: {prompt_rate:.1%}\n"
+            f"快取排程提前執行: {self.reordered} 次\n"
+            f"預熱次數: {self.warmups}\n"
+            f"首次請求平均延遲: {self.average(self.first_latencies)}\n"
+            f"一般請求平均延遲: {self.average(self.latencies)}"
+        )
+
+    @staticmethod
+    def average(latencies):
+        if not latencies:
+            return "—"
+        return f"{sum(latencies) / len(latencies):.1f} 秒 ({len(latencies)} 筆)"
+
+generation_stats = GenerationStats()
+
+# --- 任務紀錄 ---
+job_history = JobHistory(HISTORY_FILE, HISTORY_FLUSH_INTERVAL)
+
+# --- 建立佇列 worker ---
+def create_workers():
+    """主 worker 處理所有線道;設定 FAST_LANE_BACKENDS 時另有一個只處理優先與快速線道的 worker 使用保留的後端"""
+    reserved = [a for a in FAST_LANE_BACKENDS if a in COMFYUI_SERVER_ADDRESSES]
+    if len(reserved) != len(FAST_LANE_BACKENDS):
+        logger.warning("[佇列系統] FAST_LANE_BACKENDS 中有不在 COMFYUI_SERVER_ADDRESS 的位址,已忽略")
+    shared = [a for a in COMFYUI_SERVER_ADDRESSES if a not in reserved]
+    if not reserved or not shared:
+        if reserved:
+            logger.warning("[佇列系統] 不能把所有後端都保留給快速線道,改為共用")
+        return [QueueWorker("main", GenerationQueue.LANES)]
+    return [
+        QueueWorker("main", GenerationQueue.LANES, shared),
+        QueueWorker("fast", ('priority', 'fast'), reserved),
+    ]
+
 # --- 建立全域佇列 ---
-generation_queue = GenerationQueue()
+generation_queue = GenerationQueue(
+    max_length=MAX_QUEUE_LENGTH,
+    max_gpu_seconds=MAX_QUEUE_GPU_SECONDS,
+    max_bytes=MAX_QUEUE_BYTES,
+    seconds_per_unit=ESTIMATED_SECONDS_PER_IMAGE,
+    reorder_window=CACHE_REORDER_WINDOW,
+    fast_lane_seconds=FAST_LANE_MAX_SECONDS,
+    starvation_seconds=LANE_STARVATION_SECONDS,
+    workers=create_workers(),
+)
+
+# --- 建立後端池 ---
+backend_pool = BackendPool(
+    COMFYUI_SERVER_ADDRESSES,
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    failure_window=BREAKER_FAILURE_WINDOW,
+    cooldown=BREAKER_COOLDOWN,
+)
 
 # --- Discord Bot 設定 ---
 intents = discord.Intents.default()
@@ -157,65 +740,337 @@ class PromptEditModal(discord.ui.Modal, title="編輯您的提示詞"):
         
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# --- 提示詞變體視窗 ---
+class VariantPromptModal(discord.ui.Modal, title="提示詞變體"):
+    def __init__(self, current_positive, size, draft, grid):
+        super().__init__()
+        self.size = size
+        self.draft = draft
+        self.grid = grid
+
+        self.variants = discord.ui.TextInput(
+            label="每行一個正向提示詞,可用 {a|b} 展開變體",
+            style=discord.TextStyle.paragraph,
+            default=current_positive,
+            required=True,
+            max_length=4000
+        )
+        self.add_item(self.variants)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        # 按鈕一列最多 5 個,草稿/總覽圖按鈕限制了張數
+        limit = MAX_BATCH_SIZE if self.draft or self.grid else MAX_PROMPT_VARIANTS
+        try:
+            prompts = expand_prompt_variants(self.variants.value, limit)
+        except ValueError as e:
+            await interaction.response.send_message(f"❌ {str(e)}", ephemeral=True)
+            return
+
+        user_settings = user_prompts.get(interaction.user.id, {})
+        negative = user_settings.get('negative', DEFAULT_NEGATIVE_PROMPT)
+
+        position, rejection = generation_queue.add_request(
+            interaction, self.variants.value, negative, len(prompts), self.size,
+            mode='txt2img_variants', draft=self.draft, grid=self.grid, prompts=prompts
+        )
+        if rejection:
+            await interaction.response.send_message(f"❌ {rejection}", ephemeral=True)
+            return
+
+        size_info = f" [{self.size}{', 草稿' if self.draft else ''}]"
+        embed = discord.Embed(color=discord.Color.blue())
+        if position == 1 and not generation_queue.processing:
+            embed.description = f"**{interaction.user.display_name}** 的提示詞變體請求已收到 (x{len(prompts)} 個){size_info},立即開始處理!"
+        else:
+            embed.description = (
+                f"**{interaction.user.display_name}** 的提示詞變體請求已加入佇列 (x{len(prompts)} 個){size_info}\n"
+                f"你的位置:第 **{position}** 位\n"
+                f"ℹ️ {generation_queue.get_queue_info()}"
+            )
+        await interaction.response.send_message(embed=embed)
+
+# --- 結果按鈕:草稿精修/放大、總覽圖原圖(persistent view,重啟後仍可使用)---
+class ResultView(discord.ui.View):
+    def __init__(self, count, mode='txt2img', draft=False, grid=False):
+        super().__init__(timeout=None)
+        for i in range(count):
+            # 圖生圖草稿沒有保存原圖,只提供以草稿為底圖的放大
+            if draft and not mode.startswith('img2img'):
+                self.add_button(f"✨ 精修 #{i+1}", f"draft:refine:{i}", 0, refine_draft, i)
+            if draft:
+                self.add_button(f"🔍 放大 #{i+1}", f"draft:upscale:{i}", 1, upscale_draft, i)
+            if grid:
+                self.add_button(f"🖼️ 原圖 #{i+1}", f"grid:full:{i}", 2, send_full_size, i)
+
+    def add_button(self, label, custom_id, row, handler, index):
+        button = discord.ui.Button(label=label, custom_id=custom_id, row=row, style=discord.ButtonStyle.secondary)
+
+        async def callback(interaction):
+            await handler(interaction, index)
+
+        button.callback = callback
+        self.add_item(button)
+
+
+async def get_draft_for_click(interaction, index):
+    record = draft_jobs.get(interaction.message.id)
+    if not record or index >= len(record['seeds']):
+        await interaction.response.send_message("❌ 找不到這張草稿的資料,可能已過期", ephemeral=True)
+        return None
+    if interaction.user.id != record['user_id']:
+        await interaction.response.send_message("❌ 只有草稿的建立者可以精修", ephemeral=True)
+        return None
+    return record
+
+
+def draft_positive(record, index):
+    """草稿第 index 張使用的正向提示詞(提示詞變體時每張不同)"""
+    if record.get('positives'):
+        return record['positives'][index]
+    return record['positive']
+
+
+async def send_deferred_rejection(interaction, message):
+    """
+    已公開 defer 的指令要拒絕時,第一個 followup 會取代「思考中」訊息而忽略 ephemeral,
+    所以先刪除它再送出只有使用者本人看得到的訊息
+    """
+    try:
+        await interaction.delete_original_response()
+    except discord.HTTPException:
+        pass
+    await interaction.followup.send(message, ephemeral=True)
+
+
+async def send_refine_ack(interaction, position, rejection, action):
+    if rejection:
+        await interaction.followup.send(f"❌ {rejection}", ephemeral=True)
+        return
+    embed = discord.Embed(color=discord.Color.blue())
+    embed.description = (
+        f"**{interaction.user.display_name}** 的{action}請求已加入佇列\n"
+        f"你的位置:第 **{position}** 位\n"
+        f"ℹ️ {generation_queue.get_queue_info()}"
+    )
+    await interaction.followup.send(embed=embed)
+
+
+async def refine_draft(interaction, index):
+    """以相同 seed 與提示詞,用完整品質重新生成"""
+    record = await get_draft_for_click(interaction, index)
+    if not record:
+        return
+    await interaction.response.defer()
+    position, rejection = generation_queue.add_request(
+        interaction, draft_positive(record, index), record['negative'], 1, record['size'],
+        seeds=[record['seeds'][index]]
+    )
+    await send_refine_ack(interaction, position, rejection, "精修")
+
+
+async def upscale_draft(interaction, index):
+    """以草稿圖片為底圖,透過圖生圖放大到完整尺寸"""
+    record = await get_draft_for_click(interaction, index)
+    if not record:
+        return
+    await interaction.response.defer()
+    try:
+        image_bytes = await read_result_image(interaction.message, index)
+    except Exception as e:
+        await interaction.followup.send(f"❌ 無法讀取草稿圖片: {str(e)}")
+        return
+    if image_bytes is None:
+        await interaction.followup.send("❌ 找不到這張草稿的圖片", ephemeral=True)
+        return
+    position, rejection = generation_queue.add_request(
+        interaction, draft_positive(record, index), record['negative'], 1, record['size'],
+        mode='img2img', input_image=image_bytes, denoise=REFINE_UPSCALE_DENOISE,
+        seeds=[record['seeds'][index]]
+    )
+    await send_refine_ack(interaction, position, rejection, "放大")
+
+
+async def read_result_image(message, index):
+    """取得結果訊息中第 index 張原圖:總覽圖訊息從本機快取讀取,否則讀取附件"""
+    loop = asyncio.get_event_loop()
+    image_bytes = await loop.run_in_executor(None, load_original, GRID_CACHE_DIR, message.id, index)
+    if image_bytes is not None:
+        return image_bytes
+    # 快取過期的總覽圖不能當成原圖使用
+    attachments = [a for a in message.attachments if not a.filename.startswith('grid_')]
+    if index >= len(attachments):
+        return None
+    return await attachments[index].read()
+
+
+async def send_full_size(interaction, index):
+    """以僅自己可見的訊息送出總覽圖中某一格的原圖"""
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    loop = asyncio.get_event_loop()
+    image_bytes = await loop.run_in_executor(None, load_original, GRID_CACHE_DIR, interaction.message.id, index)
+    if image_bytes is None:
+        await interaction.followup.send("❌ 原圖已不在快取中,可能已過期", ephemeral=True)
+        return
+    picture = discord.File(io.BytesIO(image_bytes), filename=f"full_{interaction.message.id}_{index + 1}.png")
+    await interaction.followup.send(f"🖼️ 原圖 #{index + 1}", file=picture, ephemeral=True)
+
+
+background_tasks_started = False
+
 @bot.event
 async def on_ready():
-    print(f'[DEBUG] Bot 已登入為 {bot.user}')
+    logger.info("Bot 已登入為 %s", bot.user)
 
     try:
         synced = await bot.tree.sync()
-        print(f"[DEBUG] 已同步 {len(synced)} 個指令")
+        logger.info("已同步 %d 個指令", len(synced))
     except Exception as e:
-        print(f"[DEBUG] 同步指令失敗: {e}")
+        logger.error("同步指令失敗: %s", e)
     
-    bot.loop.create_task(process_queue())
+    # on_ready 在斷線重連後可能再次觸發,背景任務只啟動一次
+    global background_tasks_started
+    if background_tasks_started:
+        return
+    background_tasks_started = True
+    bot.add_view(ResultView(MAX_BATCH_SIZE, draft=True, grid=True))
+    for worker in generation_queue.workers:
+        bot.loop.create_task(process_queue(worker))
+    bot.loop.create_task(backend_pool.health_loop(HEALTH_CHECK_INTERVAL))
+    bot.loop.create_task(watchdog())
+    bot.loop.create_task(job_history.flush_loop())
+    if WARMUP_ENABLED:
+        backend_pool.on_recovered.append(lambda backend: bot.loop.create_task(warm_up(backend)))
+        for backend in backend_pool.backends:
+            bot.loop.create_task(warm_up(backend))
+    if KEEP_WARM_INTERVAL > 0:
+        bot.loop.create_task(keep_warm())
 
 
-async def process_queue():
-    print("[佇列系統] 已啟動")
+async def process_queue(worker):
+    logger.info("[佇列系統] worker %s 已啟動(線道: %s)", worker.name, ", ".join(worker.lanes))
     while True:
-        if len(generation_queue.queue) > 0 and not generation_queue.processing:
-            generation_queue.processing = True
-            request = generation_queue.queue.popleft()
-            generation_queue.current_task = request
+        # 保留的後端都不可用時先不取出請求,讓主 worker 處理
+        request = None
+        if worker.backends is None or backend_pool.any_available(worker.backends):
+            request = generation_queue.pop_next(worker)
+
+        if request:
+            # 預估完成前 interaction 就會過期,結果將無法送出,直接略過
+            if time.monotonic() + generation_queue.estimate_seconds(request) > request.expires_at:
+                logger.warning("[佇列系統] %s 的請求等待過久,interaction 即將過期,略過", request.user_name)
+                record_job(request, 'expired')
+                try:
+                    await request.followup.send(f"{request.user_mention} ❌ 你的請求等待過久,已無法在 Discord 互動逾時前完成,請重新送出。")
+                except Exception:
+                    pass
+                continue
+
+            worker.current_task = request
+            request.allowed_backends = worker.backends
+            # 之後此任務的所有 log 都帶上 request ID(job task 建立時會複製目前的 context)
+            bind_log_context(request_id=request.request_id)
             
-            batch_info = f" (批次: {request['batch_count']} 張)" if request['batch_count'] > 1 else ""
-            size_info = f" [{request['size']}]"
-            print(f"[佇列系統] 開始處理 {request['user_name']} 的請求{batch_info}{size_info}")
+            batch_info = f" (批次: {request.batch_count} 張)" if request.batch_count > 1 else ""
+            size_info = f" [{request.size}]"
+            logger.info("[佇列系統] %s 開始處理 %s 的請求%s%s(%s線道)", worker.name, request.user_name, batch_info, size_info, GenerationQueue.LANE_NAMES[request.lane])
             
+            request.job_state = {'started_at': time.monotonic(), 'last_activity': time.monotonic()}
+            job = asyncio.create_task(execute_generation(request))
+            worker.current_job = job
             try:
-                await execute_generation(request)
+                # 用 wait 而非直接 await,看門狗取消 job 時不會連帶中止佇列迴圈
+                await asyncio.wait({job})
+                if job.cancelled():
+                    logger.warning("[佇列系統] %s 的請求已被看門狗終止", request.user_name)
+                    record_job(request, 'cancelled')
+                elif job.result():
+                    generation_queue.record_runtime(request, time.monotonic() - request.job_state['started_at'])
+                    record_job(request, 'partial' if request.job_state.get('error') else 'success')
+                else:
+                    record_job(request, 'failed')
             except Exception as e:
-                print(f"[佇列系統] 處理請求時發生錯誤: {e}")
+                logger.exception("[佇列系統] 處理請求時發生錯誤: %s", e)
+                request.job_state['error'] = str(e)
+                record_job(request, 'error')
                 try:
-                    await request['interaction'].response.send_message(f"❌ 處理請求時發生錯誤: {str(e)}")
+                    await request.followup.send(f"❌ 處理請求時發生錯誤: {str(e)}")
                 except:
                     pass
             
-            generation_queue.processing = False
-            generation_queue.current_task = None
-            print(f"[佇列系統] 完成處理 {request['user_name']} 的請求")
+            worker.last_backend = request.job_state.get('backend')
+            worker.current_task = None
+            worker.current_job = None
+            logger.info("[佇列系統] 完成處理 %s 的請求", request.user_name)
+            bind_log_context(request_id='-')
         
         await asyncio.sleep(0.5)  # 每 0.5 秒檢查一次佇列
 
 
+def record_job(request, outcome):
+    """把結束的任務寫入任務紀錄(只放進緩衝區,由背景任務寫檔)"""
+    job_state = request.job_state or {}
+    mark_job_state(job_state, 'done')  # 結算最後一個階段的時間
+    now = time.monotonic()
+    started_at = job_state.get('started_at', now)
+    stages = job_state.get('stage_durations', {})
+    job_history.record({
+        'job_id': request.request_id,
+        'ts': time.time(),
+        'user_id': request.user_id,
+        'user_name': request.user_name,
+        'guild_id': request.guild_id,
+        'mode': request.mode,
+        'lane': request.lane,
+        'size': request.size,
+        'count': request.batch_count,
+        'draft': request.draft,
+        'grid': request.grid,
+        'denoise': request.denoise if request.mode.startswith('img2img') else None,
+        'positive': request.positive,
+        'negative': request.negative,
+        'prompts': request.prompts,
+        'seeds': job_state.get('seeds') or request.seeds,
+        'prompt_ids': job_state.get('prompt_ids', []),
+        'backend': job_state.get('backend'),
+        'attempts': job_state.get('attempts', 0),
+        'outcome': outcome,
+        'error': job_state.get('error'),
+        'images': job_state.get('images', 0),
+        'queue_wait': round(started_at - request.enqueued_at, 2),
+        'duration': round(now - started_at, 2),
+        'gpu_seconds': round(stages.get('running', 0), 2),
+        'stages': {stage: round(seconds, 2) for stage, seconds in stages.items()},
+    })
+
+
 async def execute_generation(request):
-    interaction = request['interaction']
-    positive = request['positive']
-    negative = request['negative']
-    batch_count = request['batch_count']
-    size = request['size']
-    mode = request.get('mode', 'txt2img')
-    input_image = request.get('input_image')
-    denoise = request.get('denoise', 0.75)
+    if request.mode == 'img2img_batch':
+        return await execute_batch_generation(request)
+    if request.mode == 'txt2img_variants':
+        return await execute_variant_generation(request)
+
+    positive = request.positive
+    negative = request.negative
+    batch_count = request.batch_count
+    size = request.size
+    mode = request.mode
+    denoise = request.denoise
+    draft = request.draft
+    seeds = request.seeds or [new_seed() for _ in range(batch_count)]
+    request.job_state['seeds'] = seeds
 
     batch_info = f" (共 {batch_count} 張)" if batch_count > 1 else ""
     size_display = f"**尺寸**: {size}\n"
-    mode_display = f"**模式**: {'圖生圖' if mode == 'img2img' else '文生圖'}\n"
+    mode_display = f"**模式**: {'圖生圖' if mode == 'img2img' else '文生圖'}{' (草稿)' if draft else ''}\n"
     denoise_display = f"**去噪強度**: {denoise}\n" if mode == 'img2img' else ""
+    seed_display = f"**Seed**: {', '.join(str(seed) for seed in seeds)}\n"
+    job_display = f"**任務 ID**: `{request.request_id}`\n"
     prompt_display = (
         f"{mode_display}"
         f"{size_display}"
         f"{denoise_display}"
+        f"{seed_display}"
+        f"{job_display}"
     )
 
     embed = discord.Embed(
@@ -226,7 +1081,7 @@ async def execute_generation(request):
     embed.add_field(name="負向提示詞", value=f"\n```{negative}```\n", inline=False)
     
     initial_text = f"⏳ 開始生成圖片{batch_info}...\n\n"
-    message = await interaction.followup.send(initial_text, embed=embed)
+    message = await request.followup.send(initial_text, embed=embed)
     progress_state = {'current': 0, 'total': batch_count}
     
     stop_event = asyncio.Event()
@@ -242,65 +1097,458 @@ async def execute_generation(request):
         # 循環生成多張圖片
         for i in range(batch_count):
             if batch_count > 1:
-                print(f"[生成] 正在生成第 {i+1}/{batch_count} 張圖片...")
+                logger.info("[生成] 正在生成第 %d/%d 張圖片", i + 1, batch_count)
             
-            # 根據模式選擇生成函式
-            if mode == 'img2img':
-                image_bytes, error_message = await get_image_img2img(
-                    positive, negative, input_image, COMFYUI_SERVER_ADDRESS, size, denoise
-                )
-            else:
-                image_bytes, error_message = await get_image_txt2img(
-                    positive, negative, COMFYUI_SERVER_ADDRESS, size
-                )
+            image_bytes, error_message = await generate_with_failover(request, seeds[i])
             
             if error_message:
+                request.job_state['error'] = error_message
                 stop_event.set()
                 await animation_task
-                await message.edit(content=f"{interaction.user.mention} ❌ 生成失敗(第 {i+1}/{batch_count} 張):{error_message}\n\n")
+                await message.edit(content=f"{request.user_mention} ❌ 生成失敗(第 {i+1}/{batch_count} 張):{error_message}\n\n")
                 return
             
             if image_bytes:
                 generated_images.append(image_bytes)
                 progress_state['current'] = i + 1
             else:
+                request.job_state['error'] = "無法從 ComfyUI 獲取圖片數據"
                 stop_event.set()
                 await animation_task
-                await message.edit(content=f"{interaction.user.mention} ❌ 生成失敗(第 {i+1}/{batch_count} 張),無法從 ComfyUI 獲取圖片數據。\n\n")
+                await message.edit(content=f"{request.user_mention} ❌ 生成失敗(第 {i+1}/{batch_count} 張),無法從 ComfyUI 獲取圖片數據。\n\n")
                 return
         
         stop_event.set()
         await animation_task
         
         if generated_images:
-            user_mention = interaction.user.mention
-            
-            if len(generated_images) == 1:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                mode_prefix = 'img2img' if mode == 'img2img' else 'txt2img'
-                picture = discord.File(io.BytesIO(generated_images[0]), filename=f"{mode_prefix}_{interaction.user.id}_{timestamp}_{1}.png")
-                await message.edit(content=f"{user_mention} ✅ 圖片生成完畢!\n\n", attachments=[picture])
-            else:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                mode_prefix = 'img2img' if mode == 'img2img' else 'txt2img'
-                files = [
-                    discord.File(io.BytesIO(img), filename=f"{mode_prefix}_{interaction.user.id}_{timestamp}_{i+1}.png")
-                    for i, img in enumerate(generated_images)
-                ]
-                await message.edit(content=f"{user_mention} ✅ 圖片生成完畢!(共 {len(generated_images)} 張)\n\n", attachments=files)
+            mark_job_state(request.job_state, 'deliver')
+            request.job_state['images'] = len(generated_images)
+            await deliver_images(request, message, generated_images, seeds)
+            return True
         else:
-            await message.edit(content=f"{interaction.user.mention} ❌ 生成失敗,沒有獲取到任何圖片。\n\n")
+            await message.edit(content=f"{request.user_mention} ❌ 生成失敗,沒有獲取到任何圖片。\n\n")
     
+    except asyncio.CancelledError:
+        stop_event.set()
+        animation_task.cancel()
+        await message.edit(content=f"{request.user_mention} ❌ 任務長時間沒有回應,已被強制終止,請稍後再試。\n\n")
+        raise
+
     except Exception as e:
         stop_event.set()
         try:
             await animation_task
         except:
             pass
-        await message.edit(content=f"{interaction.user.mention} ❌ 發生錯誤:{str(e)}\n\n")
+        await message.edit(content=f"{request.user_mention} ❌ 發生錯誤:{str(e)}\n\n")
         raise
 
 
+async def deliver_images(request, message, images, seeds, labels=None, positives=None):
+    """把生成結果編輯進狀態訊息:單張、多張附件,或合成總覽圖"""
+    mode = request.mode
+    draft = request.draft
+    user_mention = request.user_mention
+    grid = request.grid and len(images) > 1
+    # 草稿結果附上精修/放大按鈕,總覽圖附上原圖按鈕
+    extra = {'view': ResultView(len(images), mode, draft, grid)} if draft or grid else {}
+    draft_hint = "點擊下方按鈕以完整品質精修或放大。\n" if draft else ""
+
+    if grid:
+        # 一張壓縮過的總覽圖取代多張原圖,原圖留在本機供按鈕取用
+        loop = asyncio.get_event_loop()
+        labels = labels or [f"#{i+1}  seed {seed}" for i, seed in enumerate(seeds)]
+        sheet = await loop.run_in_executor(None, build_contact_sheet, images, labels)
+        await loop.run_in_executor(None, save_originals, GRID_CACHE_DIR, message.id, images, GRID_CACHE_MAX_FILES)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        picture = discord.File(io.BytesIO(sheet), filename=f"grid_{request.user_id}_{timestamp}.jpg")
+        await message.edit(content=f"{user_mention} ✅ 圖片生成完畢!(共 {len(images)} 張)\n點擊「原圖」按鈕取得完整尺寸。\n{draft_hint}\n", attachments=[picture], **extra)
+    elif len(images) == 1:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        mode_prefix = 'img2img' if mode == 'img2img' else 'txt2img'
+        picture = discord.File(io.BytesIO(images[0]), filename=f"{mode_prefix}_{request.user_id}_{timestamp}_{1}.png")
+        await message.edit(content=f"{user_mention} ✅ 圖片生成完畢!\n{draft_hint}\n", attachments=[picture], **extra)
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        mode_prefix = 'img2img' if mode == 'img2img' else 'txt2img'
+        files = [
+            discord.File(io.BytesIO(img), filename=f"{mode_prefix}_{request.user_id}_{timestamp}_{i+1}.png")
+            for i, img in enumerate(images)
+        ]
+        await message.edit(content=f"{user_mention} ✅ 圖片生成完畢!(共 {len(images)} 張)\n{draft_hint}\n", attachments=files, **extra)
+
+    if draft:
+        await remember_draft(message.id, request, seeds, positives)
+
+
+async def execute_variant_generation(request):
+    """
+    提示詞變體:所有變體一次提交,全部完成後以同一則訊息送出
+    """
+    prompts = request.prompts
+    total = len(prompts)
+    # 預設所有變體共用同一個 seed,差異只來自提示詞
+    seeds = request.seeds or [new_seed()] * total
+    request.job_state['seeds'] = seeds
+
+    variant_display = "\n".join(f"**#{i+1}** {prompt[:150]}" for i, prompt in enumerate(prompts))
+    embed = discord.Embed(color=discord.Color.blue())
+    embed.add_field(name="", value=(
+        f"**模式**: 提示詞變體{' (草稿)' if request.draft else ''}\n"
+        f"**尺寸**: {request.size}\n"
+        f"**Seed**: {', '.join(str(seed) for seed in dict.fromkeys(seeds))}\n"
+        f"**任務 ID**: `{request.request_id}`\n"
+    ), inline=False)
+    embed.add_field(name="正向提示詞變體", value=variant_display[:1024], inline=False)
+    embed.add_field(name="負向提示詞", value=f"\n```{request.negative}```\n", inline=False)
+
+    message = await request.followup.send(f"⏳ 開始生成 {total} 個提示詞變體...\n\n", embed=embed)
+    progress_state = {'current': 0, 'total': total}
+    stop_event = asyncio.Event()
+    animation_task = asyncio.create_task(
+        update_status_message(message, stop_event, progress_state)
+    )
+
+    results = {}
+
+    def on_image(item):
+        index, image_bytes = item
+        results[index] = image_bytes
+        progress_state['current'] = len(results)
+
+    try:
+        errors = await generate_batch_with_failover(request, seeds, on_image)
+        stop_event.set()
+        await animation_task
+
+        if not results:
+            request.job_state['error'] = errors[min(errors)]
+            await message.edit(content=f"{request.user_mention} ❌ 生成失敗:{errors[min(errors)]}\n\n")
+            return
+
+        order = sorted(results)
+        if errors:
+            request.job_state['error'] = errors[min(errors)]
+            logger.warning("[生成] %d 個變體失敗: %s", len(errors), errors[min(errors)])
+        mark_job_state(request.job_state, 'deliver')
+        request.job_state['images'] = len(order)
+        await deliver_images(
+            request, message, [results[i] for i in order], [seeds[i] for i in order],
+            labels=[f"#{i+1}  {prompts[i][:48]}" for i in order],
+            positives=[prompts[i] for i in order]
+        )
+        if errors:
+            failed = ", ".join(f"#{index + 1}" for index in sorted(errors))
+            await request.followup.send(f"{request.user_mention} ⚠️ 變體 {failed} 生成失敗:{errors[min(errors)]}")
+        return True
+
+    except asyncio.CancelledError:
+        stop_event.set()
+        animation_task.cancel()
+        await message.edit(content=f"{request.user_mention} ❌ 任務長時間沒有回應,已被強制終止,請稍後再試。\n\n")
+        raise
+
+    except Exception as e:
+        stop_event.set()
+        try:
+            await animation_task
+        except:
+            pass
+        await message.edit(content=f"{request.user_mention} ❌ 發生錯誤:{str(e)}\n\n")
+        raise
+
+
+async def execute_batch_generation(request):
+    """
+    批次圖生圖:所有輸入一次提交,完成的圖片隨即分批送出,不必等整批結束
+    """
+    total = request.batch_count
+    seeds = request.seeds or [new_seed() for _ in range(total)]
+    request.job_state['seeds'] = seeds
+
+    embed = discord.Embed(color=discord.Color.blue())
+    embed.add_field(name="", value=(
+        f"**模式**: 批次圖生圖{' (草稿)' if request.draft else ''}\n"
+        f"**尺寸**: {request.size}\n"
+        f"**去噪強度**: {request.denoise}\n"
+        f"**輸入圖片**: {total} 張\n"
+        f"**任務 ID**: `{request.request_id}`\n"
+    ), inline=False)
+    embed.add_field(name="正向提示詞", value=f"\n```{request.positive}```\n", inline=False)
+    embed.add_field(name="負向提示詞", value=f"\n```{request.negative}```\n", inline=False)
+
+    message = await request.followup.send(f"⏳ 開始批次生成 (共 {total} 張)...\n\n", embed=embed)
+    progress_state = {'current': 0, 'total': total}
+    stop_event = asyncio.Event()
+    animation_task = asyncio.create_task(
+        update_status_message(message, stop_event, progress_state)
+    )
+
+    finished = asyncio.Queue()
+    sender = asyncio.create_task(send_batch_results(request, finished, seeds, progress_state))
+
+    try:
+        errors = await generate_batch_with_failover(request, seeds, finished.put_nowait)
+        finished.put_nowait(None)
+        sent = await sender
+        request.job_state['images'] = sent
+        stop_event.set()
+        await animation_task
+
+        if not errors:
+            await message.edit(content=f"{request.user_mention} ✅ 批次生成完畢!(共 {sent} 張)\n\n")
+        else:
+            failed = ", ".join(f"#{index + 1}" for index in sorted(errors))
+            first_error = errors[min(errors)]
+            request.job_state['error'] = first_error
+            await message.edit(content=(
+                f"{request.user_mention} {'⚠️' if sent else '❌'} 批次生成完成 {sent}/{total} 張,"
+                f"失敗: {failed}\n原因:{first_error}\n\n"
+            ))
+        return sent > 0
+
+    except asyncio.CancelledError:
+        stop_event.set()
+        animation_task.cancel()
+        sender.cancel()
+        await message.edit(content=f"{request.user_mention} ❌ 任務長時間沒有回應,已被強制終止,請稍後再試。\n\n")
+        raise
+
+    except Exception as e:
+        stop_event.set()
+        sender.cancel()
+        try:
+            await animation_task
+        except:
+            pass
+        await message.edit(content=f"{request.user_mention} ❌ 發生錯誤:{str(e)}\n\n")
+        raise
+
+
+async def send_batch_results(request, finished, seeds, progress_state):
+    """
+    背景任務:把已完成的圖片合併成訊息送出(每則最多 MAX_BATCH_SIZE 張),
+    收到 None 時送出剩餘圖片並返回已送出的張數
+    """
+    sent = 0
+    done = False
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    while not done:
+        # 先等第一張,再順便帶上同時完成的其他圖片
+        ready = []
+        item = await finished.get()
+        while item is not None:
+            ready.append(item)
+            if len(ready) >= MAX_BATCH_SIZE or finished.empty():
+                break
+            item = finished.get_nowait()
+        done = item is None
+        if not ready:
+            continue
+
+        ready.sort()
+        files = [
+            discord.File(io.BytesIO(image_bytes), filename=f"img2img_{request.user_id}_{timestamp}_{index + 1}.png")
+            for index, image_bytes in ready
+        ]
+        labels = ", ".join(f"#{index + 1}" for index, _ in ready)
+        extra = {'view': ResultView(len(ready), request.mode, draft=True)} if request.draft else {}
+        result_message = await request.followup.send(
+            f"{request.user_mention} 批次結果 {labels}", files=files, **extra
+        )
+        if request.draft:
+            await remember_draft(result_message.id, request, [seeds[index] for index, _ in ready])
+        sent += len(ready)
+        progress_state['current'] = sent
+    return sent
+
+
+async def generate_batch_with_failover(request, seeds, on_image):
+    """
+    批次生成,成功的圖片以 on_image((index, image_bytes)) 回報;
+    失敗時只把尚未完成的圖片換到其他後端重試。返回 {index: 錯誤訊息}
+    """
+    job_state = request.job_state
+    draft_options = {'steps': DRAFT_STEPS, 'scale': DRAFT_SCALE} if request.draft else {}
+    pending = list(range(request.batch_count))
+    errors = {}
+    tried = []
+
+    for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+        mark_job_state(job_state, 'backend_wait')
+        backend = await backend_pool.wait_for_backend(exclude=tried, timeout=BACKEND_WAIT_TIMEOUT, only=request.allowed_backends, prefer=request.preferred_backend)
+        if backend is None:
+            for index in pending:
+                errors.setdefault(index, "目前沒有可用的 ComfyUI 後端,請稍後再試")
+            return errors
+        tried.append(backend.address)
+        job_state['attempts'] = job_state.get('attempts', 0) + 1
+        job_state.update(backend=backend.address, attempt=attempt, prompt_id=None, cached_nodes=0)
+        bind_log_context(backend=backend.address, prompt_id='-')
+        attempt_started = time.monotonic()
+
+        def on_result(position, image_bytes, error_message):
+            index = pending[position]
+            if image_bytes and not error_message:
+                errors.pop(index, None)
+                on_image((index, image_bytes))
+            else:
+                errors[index] = error_message or "無法從 ComfyUI 獲取圖片數據"
+
+        if request.mode == 'txt2img_variants':
+            await get_images_txt2img_batch(
+                [request.prompts[i] for i in pending], request.negative,
+                backend.address, request.size, JOB_TIMEOUTS, job_state,
+                seeds=[seeds[i] for i in pending], on_result=on_result, **draft_options
+            )
+        else:
+            await get_images_img2img_batch(
+                request.positive, request.negative, [request.input_images[i] for i in pending],
+                backend.address, request.size, request.denoise, JOB_TIMEOUTS, job_state,
+                seeds=[seeds[i] for i in pending], on_result=on_result, **draft_options
+            )
+        succeeded = [index for index in pending if index not in errors]
+        succeeded_positions = [position for position, index in enumerate(pending) if index not in errors]
+        pending = [index for index in pending if index in errors]
+
+        if succeeded:
+            backend_pool.record_success(backend)
+            generation_stats.record_prompts(job_state, succeeded_positions)
+            generation_stats.record_latency(time.monotonic() - attempt_started, backend.first_request_pending)
+            backend.first_request_pending = False
+        if not pending:
+            return errors
+
+        # 工作流程本身設定錯誤,換後端也無濟於事
+        if job_state.get('stage') == 'prepare':
+            return errors
+
+        if not succeeded:
+            backend_pool.record_failure(backend, errors[pending[0]])
+        logger.warning("[佇列系統] 第 %d/%d 次嘗試有 %d 張失敗: %s", attempt, JOB_MAX_ATTEMPTS, len(pending), errors[pending[0]])
+
+    return errors
+
+
+async def generate_with_failover(request, seed):
+    """
+    生成單張圖片,失敗或逾時時換到其他健康的後端重試
+    """
+    job_state = request.job_state
+    draft_options = {'steps': DRAFT_STEPS, 'scale': DRAFT_SCALE} if request.draft else {}
+    tried = []
+    error_message = None
+
+    for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+        mark_job_state(job_state, 'backend_wait')
+        backend = await backend_pool.wait_for_backend(exclude=tried, timeout=BACKEND_WAIT_TIMEOUT, only=request.allowed_backends, prefer=request.preferred_backend)
+        if backend is None:
+            return None, error_message or "目前沒有可用的 ComfyUI 後端,請稍後再試"
+        tried.append(backend.address)
+        job_state['attempts'] = job_state.get('attempts', 0) + 1
+        job_state.update(backend=backend.address, attempt=attempt, prompt_id=None, cached_nodes=0)
+        bind_log_context(backend=backend.address, prompt_id='-')
+        attempt_started = time.monotonic()
+
+        if request.mode == 'img2img':
+            image_bytes, error_message = await get_image_img2img(
+                request.positive, request.negative, request.input_image, backend.address,
+                request.size, request.denoise, JOB_TIMEOUTS, job_state,
+                seed=seed, **draft_options
+            )
+        else:
+            image_bytes, error_message = await get_image_txt2img(
+                request.positive, request.negative, backend.address, request.size,
+                JOB_TIMEOUTS, job_state, seed=seed, **draft_options
+            )
+
+        if image_bytes and not error_message:
+            backend_pool.record_success(backend)
+            generation_stats.record_prompts(job_state)
+            generation_stats.record_latency(time.monotonic() - attempt_started, backend.first_request_pending)
+            backend.first_request_pending = False
+            return image_bytes, None
+        error_message = error_message or "無法從 ComfyUI 獲取圖片數據"
+
+        # 工作流程本身設定錯誤,換後端也無濟於事
+        if job_state.get('stage') == 'prepare':
+            return None, error_message
+
+        backend_pool.record_failure(backend, error_message)
+        logger.warning("[佇列系統] 第 %d/%d 次嘗試失敗: %s", attempt, JOB_MAX_ATTEMPTS, error_message)
+
+    return None, error_message
+
+
+async def warm_up(backend):
+    """預熱單一後端,讓使用者的第一個請求不必等待模型載入"""
+    bind_log_context(request_id='warmup', backend=backend.address)
+    logger.info("[預熱] 開始預熱")
+    started = time.monotonic()
+    errors = await warm_up_backend(backend.address, JOB_TIMEOUTS)
+    backend.last_used = time.monotonic()
+    if errors:
+        logger.warning("[預熱] 預熱失敗: %s", '; '.join(errors))
+    else:
+        generation_stats.warmups += 1
+        logger.info("[預熱] 預熱完成,耗時 %.1f 秒", time.monotonic() - started)
+
+
+async def keep_warm():
+    """背景任務:佇列閒置時定期預熱久未使用的後端,避免模型被卸載"""
+    while True:
+        await asyncio.sleep(min(KEEP_WARM_INTERVAL, 60))
+        if generation_queue.processing or generation_queue.queue:
+            continue
+        for backend in backend_pool.backends:
+            if backend.is_available() and time.monotonic() - backend.last_used >= KEEP_WARM_INTERVAL:
+                await warm_up(backend)
+
+
+def watchdog_limits(request):
+    """
+    返回 (閒置上限, 總執行上限) 秒數:閒置上限依任務目前的階段,
+    總執行上限依此請求的張數與重試次數
+    """
+    stage_limits = {
+        'upload': JOB_TIMEOUTS['upload'],
+        'submit': JOB_TIMEOUTS['submit'] * 2,  # 連線 WebSocket 與提交 prompt 各自計時
+        'queued': JOB_TIMEOUTS['first_event'],
+        'backend_wait': BACKEND_WAIT_TIMEOUT,
+    }
+    stage = (request.job_state or {}).get('stage')
+    stall_limit = stage_limits.get(stage, JOB_TIMEOUTS['idle']) + WATCHDOG_GRACE
+    runtime_limit = (JOB_TIMEOUTS['total'] + BACKEND_WAIT_TIMEOUT) * JOB_MAX_ATTEMPTS * request.batch_count + WATCHDOG_GRACE
+    return stall_limit, runtime_limit
+
+
+async def watchdog():
+    """
+    背景任務：偵測卡住的任務(超過目前階段的期限仍無動靜)並強制終止
+    """
+    while True:
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        for worker in generation_queue.workers:
+            request = worker.current_task
+            job = worker.current_job
+            if not request or not job or job.done():
+                continue
+
+            job_state = request.job_state or {}
+            now = time.monotonic()
+            idle = now - job_state.get('last_activity', now)
+            runtime = now - job_state.get('started_at', now)
+            stall_limit, runtime_limit = watchdog_limits(request)
+            if idle > stall_limit or runtime > runtime_limit:
+                logger.error(
+                    "[看門狗] %s 的任務 %s 疑似卡住(階段: %s, 後端: %s, prompt_id: %s, 閒置 %.0fs, 執行 %.0fs),強制終止",
+                    request.user_name, request.request_id, job_state.get('stage'), job_state.get('backend'),
+                    job_state.get('prompt_id'), idle, runtime
+                )
+                job.cancel()
+
+
 
 async def update_status_message(message, stop_event, progress_state):
     """
@@ -331,7 +1579,7 @@ async def update_status_message(message, stop_event, progress_state):
     except discord.errors.NotFound:
         pass
     except Exception as e:
-        print(f"更新狀態訊息時發生錯誤: {e}")
+        logger.error("更新狀態訊息時發生錯誤: %s", e)
 
 @bot.tree.command(name="editprompts", description="編輯你的正向與負向提示詞")
 async def edit_prompts(interaction: discord.Interaction):
@@ -364,26 +1612,33 @@ async def check_prompts(interaction: discord.Interaction):
 @bot.tree.command(name="txt2img", description="文生圖")
 @app_commands.describe(
     count="要生成的圖片數量 (1-4)",
-    size="選擇圖片的尺寸"
+    size="選擇圖片的尺寸",
+    draft="草稿模式:較少步數與較小尺寸快速預覽,之後可一鍵精修",
+    grid="總覽圖:多張結果合成一張縮圖,需要時再取得原圖"
 )
 @app_commands.choices(size=[
     discord.app_commands.Choice(name="直式 (vertical)", value="vertical"),
     discord.app_commands.Choice(name="方形 (square)", value="square"),
     discord.app_commands.Choice(name="橫式 (horizontal)", value="horizontal"),
 ])
-async def txt2img(interaction: discord.Interaction, count: app_commands.Range[int, 1, 4], size: str = 'vertical'):
+async def txt2img(interaction: discord.Interaction, count: app_commands.Range[int, 1, 4], size: str = 'vertical', draft: bool = False, grid: bool = False):
     user_id = interaction.user.id
     
-    await interaction.response.defer()
-    
     user_settings = user_prompts.get(user_id, {})
     positive = user_settings.get('positive', DEFAULT_POSITIVE_PROMPT)
     negative = user_settings.get('negative', DEFAULT_NEGATIVE_PROMPT)
     
-    position = generation_queue.add_request(interaction, positive, negative, count, size)
+    # 先檢查再 defer,拒絕訊息才能只讓使用者本人看到
+    request, rejection = generation_queue.prepare_request(interaction, positive, negative, count, size, draft=draft, grid=grid)
+    if rejection:
+        await interaction.response.send_message(f"❌ {rejection}", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+    position = generation_queue.enqueue(request)
     
     batch_info = f" (x{count} 張)" if count > 1 else ""
-    size_info = f" [{size}]"
+    size_info = f" [{size}{', 草稿' if draft else ''}]"
 
     embed = discord.Embed(color=discord.Color.blue())
     
@@ -403,7 +1658,9 @@ async def txt2img(interaction: discord.Interaction, count: app_commands.Range[in
     image="上傳要重繪的圖片",
     denoise="去噪強度 (0.1-1.0,越高變化越大)",
     count="要生成的圖片數量 (1-4)",
-    size="選擇圖片的尺寸"
+    size="選擇圖片的尺寸",
+    draft="草稿模式:較少步數與較小尺寸快速預覽,之後可一鍵放大",
+    grid="總覽圖:多張結果合成一張縮圖,需要時再取得原圖"
 )
 @app_commands.choices(size=[
     discord.app_commands.Choice(name="直式 (vertical)", value="vertical"),
@@ -415,7 +1672,9 @@ async def img2img_generate(
     image: discord.Attachment,
     denoise: app_commands.Range[float, 0.1, 1.0] = 0.75,
     count: app_commands.Range[int, 1, 4] = 1,
-    size: str = 'vertical'
+    size: str = 'vertical',
+    draft: bool = False,
+    grid: bool = False
 ):
     user_id = interaction.user.id
     
@@ -428,20 +1687,32 @@ async def img2img_generate(
     try:
         image_bytes = await image.read()
     except Exception as e:
-        await interaction.followup.send(f"❌ 無法讀取圖片: {str(e)}")
+        await send_deferred_rejection(interaction, f"❌ 無法讀取圖片: {str(e)}")
+        return
+
+    # 在加入佇列前就解碼,無法解碼的圖片是使用者的問題,不該讓後端重試或觸發斷路器
+    try:
+        loop = asyncio.get_event_loop()
+        image_bytes = await loop.run_in_executor(None, encode_png, image_bytes)
+    except Exception as e:
+        logger.info("[圖生圖] %s 上傳的圖片無法解碼: %s", interaction.user.display_name, e)
+        await send_deferred_rejection(interaction, f"❌ 無法解碼圖片 {image.filename},請上傳 PNG、JPEG 或 WebP 等常見格式")
         return
     
     user_settings = user_prompts.get(user_id, {})
     positive = user_settings.get('positive', DEFAULT_POSITIVE_PROMPT)
     negative = user_settings.get('negative', DEFAULT_NEGATIVE_PROMPT)
     
-    position = generation_queue.add_request(
+    position, rejection = generation_queue.add_request(
         interaction, positive, negative, count, size, 
-        mode='img2img', input_image=image_bytes, denoise=denoise
+        mode='img2img', input_image=image_bytes, denoise=denoise, draft=draft, grid=grid
     )
+    if rejection:
+        await send_deferred_rejection(interaction, f"❌ {rejection}")
+        return
     
     batch_info = f" (x{count} 張)" if count > 1 else ""
-    size_info = f" [{size}]"
+    size_info = f" [{size}{', 草稿' if draft else ''}]"
     denoise_info = f" (去噪: {denoise})"
     
     # 建立 Embed 顯示原圖縮圖
@@ -459,17 +1730,131 @@ async def img2img_generate(
         )
         await interaction.followup.send(embed=embed)
 
+@bot.tree.command(name="variants", description="一次生成多個提示詞變體並排比較")
+@app_commands.describe(
+    size="選擇圖片的尺寸",
+    draft="草稿模式:較少步數與較小尺寸快速預覽,之後可一鍵精修",
+    grid="總覽圖:多張結果合成一張縮圖,需要時再取得原圖"
+)
+@app_commands.choices(size=[
+    discord.app_commands.Choice(name="直式 (vertical)", value="vertical"),
+    discord.app_commands.Choice(name="方形 (square)", value="square"),
+    discord.app_commands.Choice(name="橫式 (horizontal)", value="horizontal"),
+])
+async def prompt_variants(interaction: discord.Interaction, size: str = 'vertical', draft: bool = False, grid: bool = False):
+    user_settings = user_prompts.get(interaction.user.id, {})
+    positive = user_settings.get('positive', DEFAULT_POSITIVE_PROMPT)
+    await interaction.response.send_modal(VariantPromptModal(positive, size, draft, grid))
+
+@bot.tree.command(name="img2imgbatch", description="批次圖生圖:一次重繪多張圖片或 zip 壓縮檔")
+@app_commands.describe(
+    archive="包含多張圖片的 zip 壓縮檔(依檔名順序處理)",
+    image1="要重繪的圖片",
+    image2="要重繪的圖片",
+    image3="要重繪的圖片",
+    image4="要重繪的圖片",
+    denoise="去噪強度 (0.1-1.0,越高變化越大)",
+    size="選擇圖片的尺寸",
+    draft="草稿模式:較少步數與較小尺寸快速預覽,之後可一鍵放大"
+)
+@app_commands.choices(size=[
+    discord.app_commands.Choice(name="直式 (vertical)", value="vertical"),
+    discord.app_commands.Choice(name="方形 (square)", value="square"),
+    discord.app_commands.Choice(name="橫式 (horizontal)", value="horizontal"),
+])
+async def img2img_batch(
+    interaction: discord.Interaction,
+    archive: discord.Attachment = None,
+    image1: discord.Attachment = None,
+    image2: discord.Attachment = None,
+    image3: discord.Attachment = None,
+    image4: discord.Attachment = None,
+    denoise: app_commands.Range[float, 0.1, 1.0] = 0.75,
+    size: str = 'vertical',
+    draft: bool = False
+):
+    user_id = interaction.user.id
+    attachments = [image for image in (image1, image2, image3, image4) if image]
+
+    if not attachments and not archive:
+        await interaction.response.send_message("❌ 請上傳圖片或 zip 壓縮檔!", ephemeral=True)
+        return
+    if any(not image.content_type or not image.content_type.startswith('image/') for image in attachments):
+        await interaction.response.send_message("❌ 請上傳圖片檔案!", ephemeral=True)
+        return
+    if sum(a.size for a in attachments + [archive] if a) > MAX_QUEUE_BYTES:
+        await interaction.response.send_message("❌ 上傳的檔案過大!", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+
+    loop = asyncio.get_event_loop()
+    try:
+        contents = await asyncio.gather(*(image.read() for image in attachments))
+        named_images = [(image.filename, data) for image, data in zip(attachments, contents)]
+        if archive:
+            archive_bytes = await archive.read()
+            named_images += await loop.run_in_executor(
+                None, extract_archive_images, archive_bytes,
+                MAX_BATCH_INPUTS - len(named_images), MAX_QUEUE_BYTES - sum(len(data) for _, data in named_images)
+            )
+    except ValueError as e:
+        await send_deferred_rejection(interaction, f"❌ {str(e)}")
+        return
+    except Exception as e:
+        await send_deferred_rejection(interaction, f"❌ 無法讀取圖片: {str(e)}")
+        return
+
+    # 無法解碼的圖片在加入佇列前就略過,不會送到後端重試
+    input_images, failed = await loop.run_in_executor(None, encode_input_images, named_images)
+    skipped_info = f"\n⚠️ 已略過無法解碼的圖片: {', '.join(failed)}" if failed else ""
+    if not input_images:
+        await send_deferred_rejection(interaction, f"❌ 沒有可以解碼的圖片,請上傳 PNG、JPEG 或 WebP 等常見格式{skipped_info}")
+        return
+
+    user_settings = user_prompts.get(user_id, {})
+    positive = user_settings.get('positive', DEFAULT_POSITIVE_PROMPT)
+    negative = user_settings.get('negative', DEFAULT_NEGATIVE_PROMPT)
+
+    count = len(input_images)
+    position, rejection = generation_queue.add_request(
+        interaction, positive, negative, count, size,
+        mode='img2img_batch', denoise=denoise, draft=draft, input_images=input_images
+    )
+    if rejection:
+        await send_deferred_rejection(interaction, f"❌ {rejection}")
+        return
+
+    size_info = f" [{size}{', 草稿' if draft else ''}]"
+    denoise_info = f" (去噪: {denoise})"
+
+    embed = discord.Embed(color=discord.Color.blue())
+    if position == 1 and not generation_queue.processing:
+        embed.description = f"**{interaction.user.display_name}** 的批次圖生圖請求已收到 (x{count} 張){size_info}{denoise_info},立即開始處理!{skipped_info}"
+        await interaction.followup.send(embed=embed)
+    else:
+        embed.description = (
+            f"**{interaction.user.display_name}** 的批次圖生圖請求已加入佇列 (x{count} 張){size_info}{denoise_info}\n"
+            f"你的位置:第 **{position}** 位\n"
+            f"ℹ️ {generation_queue.get_queue_info()}{skipped_info}"
+        )
+        await interaction.followup.send(embed=embed)
+
 @bot.tree.command(name="queue", description="查看目前的佇列狀態")
 async def check_queue(interaction: discord.Interaction):
     user_id = interaction.user.id
     position = generation_queue.get_queue_position(user_id)
     
     info = generation_queue.get_queue_info()
+    if len(backend_pool) > 1:
+        info += f"\n後端: {backend_pool.status_text()}"
     
     if position > 0:
+        lane = generation_queue.queue[position - 1].lane
         await interaction.response.send_message(
             f"**佇列狀態**\n"
-            f"你的位置:第 **{position}** 位\n"
+            f"你的位置:第 **{position}** 位({GenerationQueue.LANE_NAMES[lane]}線道,"
+            f"預估等待 {format_duration(generation_queue.estimate_wait(lane))})\n"
             f"{info}",
             ephemeral=True
         )
@@ -477,18 +1862,89 @@ async def check_queue(interaction: discord.Interaction):
         await interaction.response.send_message(f"**佇列狀態**\n{info}\n\n你目前沒有請求在佇列中。", ephemeral=True)
 
 
+@bot.tree.command(name="stats", description="查看生成統計(快取命中率等)")
+async def show_stats(interaction: discord.Interaction):
+    embed = discord.Embed(title="生成統計", color=discord.Color.blue())
+    embed.description = generation_stats.summary()
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="rerun", description="以相同參數與 seed 重新執行過去的任務")
+@app_commands.describe(job_id="任務 ID(顯示在結果訊息中)")
+async def rerun_job(interaction: discord.Interaction, job_id: str):
+    # 所有檢查都在 defer 之前,錯誤訊息才能只讓使用者本人看到
+    entry = await job_history.find(job_id.strip().strip('`'))
+    if not entry:
+        await interaction.response.send_message("❌ 找不到這個任務 ID", ephemeral=True)
+        return
+    # 管理員只能重新執行自己伺服器中的任務
+    is_guild_admin = interaction.guild_id and entry.get('guild_id') == interaction.guild_id and interaction.permissions.manage_guild
+    if entry['user_id'] != interaction.user.id and not is_guild_admin:
+        await interaction.response.send_message("❌ 只能重新執行自己的任務", ephemeral=True)
+        return
+    if entry['mode'] not in ('txt2img', 'txt2img_variants'):
+        await interaction.response.send_message("❌ 圖生圖任務沒有保存原圖,無法重新執行", ephemeral=True)
+        return
+    if not entry.get('seeds'):
+        await interaction.response.send_message("❌ 這個任務沒有 seed 紀錄,無法重新執行", ephemeral=True)
+        return
+
+    request, rejection = generation_queue.prepare_request(
+        interaction, entry['positive'], entry['negative'], len(entry['seeds']), entry['size'],
+        mode=entry['mode'], draft=entry['draft'], seeds=entry['seeds'],
+        grid=entry.get('grid', False), prompts=entry.get('prompts')
+    )
+    if rejection:
+        await interaction.response.send_message(f"❌ {rejection}", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+    position = generation_queue.enqueue(request)
+    await send_refine_ack(interaction, position, None, "重新執行")
+
+
+@bot.tree.command(name="jobstats", description="(管理員)查看任務吞吐量、延遲與各後端表現")
+@app_commands.describe(hours="統計最近幾小時 (預設 24)")
+@app_commands.default_permissions(manage_guild=True)
+@app_commands.guild_only()
+async def job_stats(interaction: discord.Interaction, hours: app_commands.Range[int, 1, 2160] = 24):
+    await interaction.response.defer(ephemeral=True)
+    entries = await load_guild_history(interaction, hours)
+    loop = asyncio.get_event_loop()
+    embed = discord.Embed(title=f"最近 {hours} 小時任務統計", color=discord.Color.blue())
+    embed.description = await loop.run_in_executor(None, throughput_summary, entries, hours)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="topusers", description="(管理員)查看 GPU 用量最多的使用者")
+@app_commands.describe(hours="統計最近幾小時 (預設 24)")
+@app_commands.default_permissions(manage_guild=True)
+@app_commands.guild_only()
+async def top_users(interaction: discord.Interaction, hours: app_commands.Range[int, 1, 2160] = 24):
+    await interaction.response.defer(ephemeral=True)
+    entries = await load_guild_history(interaction, hours)
+    loop = asyncio.get_event_loop()
+    embed = discord.Embed(title=f"最近 {hours} 小時 GPU 用量排行", color=discord.Color.blue())
+    embed.description = await loop.run_in_executor(None, top_consumers, entries)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+
+async def load_guild_history(interaction, hours):
+    """讀取最近的任務紀錄,只統計指令所在伺服器的任務"""
+    entries = await job_history.load(since_hours(hours))
+    return [entry for entry in entries if interaction.guild_id and entry.get('guild_id') == interaction.guild_id]
+
+
 @bot.tree.command(name="cancel", description="取消你在佇列中的請求")
 async def cancel_request(interaction: discord.Interaction):
     user_id = interaction.user.id
     
-    initial_length = len(generation_queue.queue)
-    generation_queue.queue = deque([req for req in generation_queue.queue if req['user_id'] != user_id])
-    removed = initial_length - len(generation_queue.queue)
+    removed = generation_queue.remove_user_requests(user_id)
     
     if removed > 0:
         await interaction.response.send_message(f"✅ 已取消你的 **{removed}** 個請求")
     else:
-        if generation_queue.current_task and generation_queue.current_task['user_id'] == user_id:
+        if any(task.user_id == user_id for task in generation_queue.current_tasks):
             await interaction.response.send_message("⚠️ 你的請求正在處理中，無法取消")
         else:
             await interaction.response.send_message("ℹ️ 你沒有在佇列中的請求")
@@ -506,12 +1962,21 @@ async def comfy_help(interaction: discord.Interaction):
     help_embed.add_field(
         name="**圖片生成**",
         value=(
-            "`/txt2img [數量] [尺寸]`\n"
+            "`/txt2img [數量] [尺寸] [草稿] [總覽圖]`\n"
             "文生圖 - 從文字生成圖片(預設 1 張 vertical)\n\n"
-            "`/img2img <圖片> [去噪] [數量] [尺寸]`\n"
+            "`/img2img <圖片> [去噪] [數量] [尺寸] [草稿] [總覽圖]`\n"
             "圖生圖 - 重繪上傳的圖片\n"
             "  • 去噪強度: 0.1-1.0 (預設 0.75)\n"
             "  • 越高變化越大,越低越接近原圖\n\n"
+            "`/variants [尺寸] [草稿] [總覽圖]`\n"
+            f"提示詞變體 - 每行一個提示詞,或用 `{{a|b}}` 展開(最多 {MAX_PROMPT_VARIANTS} 個),\n"
+            "使用相同 seed 一次生成並排比較\n\n"
+            f"`/img2imgbatch [zip] [圖片1-4] [去噪] [尺寸] [草稿]`\n"
+            f"批次圖生圖 - 一次重繪多張圖片(最多 {MAX_BATCH_INPUTS} 張),完成的圖片會陸續送出\n\n"
+            "草稿模式:以較少步數與較小尺寸快速預覽,\n"
+            "結果下方的按鈕可用相同 seed 完整品質精修或放大\n\n"
+            "總覽圖:多張結果合成一張標有 seed 的縮圖,\n"
+            "點擊「原圖」按鈕取得完整尺寸\n\n"
             "尺寸選項:\n"
             "  • `square` - 正方形 (1024x1024)\n"
             "  • `vertical` - 直式 (832x1216) [預設]\n"
@@ -546,9 +2011,15 @@ async def comfy_help(interaction: discord.Interaction):
         name="**佇列管理**",
         value=(
             "`/queue`\n"
-            "查看目前的佇列狀態和你的位置\n\n"
+            "查看目前的佇列狀態、各線道等待數和你的位置\n\n"
             "`/cancel`\n"
             "取消你在佇列中的請求\n\n"
+            "`/stats`\n"
+            "查看生成統計(快取命中率等)\n\n"
+            "`/rerun <任務 ID>`\n"
+            "以相同參數與 seed 重新執行過去的文生圖任務\n\n"
+            "`/jobstats [小時]`、`/topusers [小時]`\n"
+            "(管理員)任務吞吐量、延遲百分位數與用量排行\n\n"
         ),
         inline=False
     )
@@ -560,7 +2031,7 @@ async def comfy_help(interaction: discord.Interaction):
             "• 每個用戶的提示詞設定是**獨立**的\n"
             "• 如果未設定提示詞，將使用預設值\n"
             f"• 批次生成上限為 **{MAX_BATCH_SIZE}** 張\n"
-            "• 佇列系統會依序處理每個請求\n"
+            "• 小型任務(如單張草稿)走快速線道,不必等大型任務\n"
             "• 預設圖片尺寸為 vertical (832x1216)\n"
         ),
         inline=False
@@ -575,9 +2046,10 @@ async def comfy_help(interaction: discord.Interaction):
 def main():
     """主入口函數"""
     if not DISCORD_TOKEN:
-        print("錯誤：找不到 Discord Bot Token。請確保你的 .env 檔案中已設定 DISCORD_TOKEN。")
+        logger.error("找不到 Discord Bot Token。請確保你的 .env 檔案中已設定 DISCORD_TOKEN。")
         return
-    bot.run(DISCORD_TOKEN)
+    # 使用上方設定的非阻塞日誌,不讓 discord.py 另外安裝 handler
+    bot.run(DISCORD_TOKEN, log_handler=None)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import io
+import logging
+import os
+
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+GRID_CELL_WIDTH = 512
+GRID_LABEL_HEIGHT = 28
+GRID_JPEG_QUALITY = 85
+
+
+# --- 合成縮圖總覽(在執行緒中執行,不阻塞事件迴圈)---
+def build_contact_sheet(images, labels, cell_width=GRID_CELL_WIDTH):
+    """
+    把多張圖片縮小後拼成一張總覽圖,每格下方標上 label;返回 JPEG bytes
+    """
+    thumbnails = []
+    for image_bytes in images:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.draft('RGB', (cell_width, cell_width * 4))  # JPEG 可直接以較小尺寸解碼
+            image = image.convert('RGB')
+            cell_height = round(image.height * cell_width / image.width)
+            # reducing_gap 先以整數倍快速縮小,再做高品質重採樣
+            thumbnails.append(image.resize((cell_width, cell_height), Image.LANCZOS, reducing_gap=2.0))
+
+    columns = 2 if len(thumbnails) > 1 else 1
+    rows = (len(thumbnails) + columns - 1) // columns
+    cell_height = max(thumbnail.height for thumbnail in thumbnails) + GRID_LABEL_HEIGHT
+    sheet = Image.new('RGB', (columns * cell_width, rows * cell_height), (0, 0, 0))
+    draw = ImageDraw.Draw(sheet)
+    font = _label_font()
+
+    for i, (thumbnail, label) in enumerate(zip(thumbnails, labels)):
+        x = (i % columns) * cell_width
+        y = (i // columns) * cell_height
+        sheet.paste(thumbnail, (x, y))
+        draw.text((x + 8, y + thumbnail.height + 6), label, fill=(255, 255, 255), font=font)
+
+    output = io.BytesIO()
+    sheet.save(output, format='JPEG', quality=GRID_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def _label_font():
+    try:
+        return ImageFont.load_default(size=18)
+    except TypeError:
+        # Pillow < 10.1 的預設字型不支援指定大小
+        return ImageFont.load_default()
+
+
+# --- 原圖快取(供「原圖」按鈕使用)---
+def original_path(cache_dir, message_id, index):
+    return os.path.join(cache_dir, f"{message_id}_{index}.png")
+
+
+def save_originals(cache_dir, message_id, images, max_files):
+    """儲存原圖,並刪除最舊的檔案使快取不超過 max_files 個"""
+    os.makedirs(cache_dir, exist_ok=True)
+    for index, image_bytes in enumerate(images):
+        with open(original_path(cache_dir, message_id, index), 'wb') as f:
+            f.write(image_bytes)
+
+    entries = sorted(os.scandir(cache_dir), key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:max(len(entries) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError as e:
+            logger.warning("[原圖快取] 無法刪除 %s: %s", entry.path, e)
+
+
+def load_original(cache_dir, message_id, index):
+    """讀取快取的原圖,不存在時返回 None"""
+    try:
+        with open(original_path(cache_dir, message_id, index), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
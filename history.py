@@ -0,0 +1,167 @@
+import asyncio
+import atexit
+import json
+import logging
+import math
+import time
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+# --- 任務紀錄(append-only JSONL)---
+class JobHistory:
+    """
+    記錄每個完成的任務。record() 只放進記憶體緩衝區,
+    由 flush_loop 在背景定期批次寫入檔案,不影響任務處理
+    """
+    def __init__(self, path, flush_interval=5, batch_size=100):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer = []
+        self._full = asyncio.Event()
+        atexit.register(self.flush_sync)
+
+    def record(self, entry):
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self._full.set()
+
+    async def flush_loop(self):
+        """背景任務:每 flush_interval 秒或緩衝區滿時寫入檔案"""
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        entries, self.buffer = self.buffer, []
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._append, entries)
+        except Exception as e:
+            # 放回緩衝區,下次再試
+            self.buffer[:0] = entries
+            logger.error("[任務紀錄] 寫入 %s 失敗: %s", self.path, e)
+
+    def flush_sync(self):
+        """程式結束時寫出剩餘的紀錄"""
+        entries, self.buffer = self.buffer, []
+        if entries:
+            self._append(entries)
+
+    def _append(self, entries):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+
+    def _read(self, since=None):
+        entries = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 寫入中途或損毀的行
+                    if since is None or entry.get('ts', 0) >= since:
+                        entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    async def load(self, since=None):
+        """讀取紀錄(包含尚未寫入檔案的),since 為 Unix 時間戳記"""
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(None, self._read, since)
+        return entries + [entry for entry in self.buffer if since is None or entry['ts'] >= since]
+
+    async def find(self, job_id):
+        for entry in reversed(await self.load()):
+            if entry.get('job_id') == job_id:
+                return entry
+        return None
+
+
+# --- 統計 ---
+def percentile(values, p):
+    """最近秩法百分位數"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def format_percentiles(values):
+    if not values:
+        return "—"
+    return " / ".join(f"p{p} {percentile(values, p):.1f}s" for p in (50, 90, 99))
+
+
+def throughput_summary(entries, hours):
+    """整體吞吐量、延遲百分位數與各後端表現"""
+    if not entries:
+        return "這段時間內沒有任務紀錄"
+
+    outcomes = Counter(entry['outcome'] for entry in entries)
+    images = sum(entry.get('images', 0) for entry in entries)
+    gpu_seconds = sum(entry.get('gpu_seconds', 0) for entry in entries)
+    succeeded = [entry for entry in entries if entry.get('images')]
+    durations = [entry['duration'] for entry in succeeded]
+    per_image = [entry['duration'] / entry['images'] for entry in succeeded]
+    waits = [entry['queue_wait'] for entry in entries if 'queue_wait' in entry]
+
+    by_backend = defaultdict(list)
+    for entry in succeeded:
+        by_backend[entry.get('backend') or '—'].append(entry.get('gpu_seconds', 0) / entry['images'])
+
+    lines = [
+        f"任務: {len(entries)}(" + ", ".join(f"{outcome} {count}" for outcome, count in outcomes.most_common()) + ")",
+        f"圖片: {images} 張,每小時 {images / hours:.1f} 張",
+        f"GPU 時間: {gpu_seconds / 60:.1f} 分鐘",
+        f"任務耗時: {format_percentiles(durations)}",
+        f"每張耗時: {format_percentiles(per_image)}",
+        f"佇列等待: {format_percentiles(waits)}",
+    ]
+    by_lane = defaultdict(list)
+    for entry in entries:
+        if 'queue_wait' in entry:
+            by_lane[entry.get('lane') or 'normal'].append(entry['queue_wait'])
+    if len(by_lane) > 1:
+        lines.append("各線道佇列等待:")
+        for lane, lane_waits in sorted(by_lane.items()):
+            lines.append(f"  {lane}: {format_percentiles(lane_waits)} ({len(lane_waits)} 筆)")
+    if by_backend:
+        lines.append("各後端每張 GPU 秒數:")
+        for backend, seconds in sorted(by_backend.items(), key=lambda item: percentile(item[1], 50)):
+            lines.append(f"  {backend}: {format_percentiles(seconds)} ({len(seconds)} 筆)")
+    return "\n".join(lines)
+
+
+def top_consumers(entries, limit=10):
+    """依 GPU 時間排序的使用者"""
+    usage = defaultdict(lambda: {'name': '', 'jobs': 0, 'images': 0, 'gpu_seconds': 0.0})
+    for entry in entries:
+        user = usage[entry['user_id']]
+        user['name'] = entry.get('user_name', user['name'])
+        user['jobs'] += 1
+        user['images'] += entry.get('images', 0)
+        user['gpu_seconds'] += entry.get('gpu_seconds', 0)
+    if not usage:
+        return "這段時間內沒有任務紀錄"
+
+    ranked = sorted(usage.values(), key=lambda user: user['gpu_seconds'], reverse=True)[:limit]
+    return "\n".join(
+        f"{rank}. {user['name']} — {user['gpu_seconds'] / 60:.1f} 分鐘,{user['images']} 張,{user['jobs']} 個任務"
+        for rank, user in enumerate(ranked, 1)
+    )
+
+
+def since_hours(hours):
+    return time.time() - hours * 3600
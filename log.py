@@ -0,0 +1,67 @@
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+
+# --- 每個任務的關聯資訊(asyncio task 各自獨立)---
+request_id_var = contextvars.ContextVar('request_id', default='-')
+prompt_id_var = contextvars.ContextVar('prompt_id', default='-')
+backend_var = contextvars.ContextVar('backend', default='-')
+
+# 每隔幾個取樣步數記錄一次進度,0 表示不記錄
+PROGRESS_LOG_EVERY = 0
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s req=%(request_id)s prompt=%(prompt_id)s backend=%(backend)s | %(message)s"
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """在產生 log 的 task 上取出關聯資訊,寫入 record"""
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.prompt_id = prompt_id_var.get()
+        record.backend = backend_var.get()
+        return True
+
+
+def bind_log_context(request_id=None, prompt_id=None, backend=None):
+    """設定目前 task 之後所有 log 的關聯資訊"""
+    if request_id is not None:
+        request_id_var.set(request_id)
+    if prompt_id is not None:
+        prompt_id_var.set(prompt_id)
+    if backend is not None:
+        backend_var.set(backend)
+
+
+def setup_logging(level="INFO", log_file=None, progress_every=0):
+    """
+    設定 root logger:事件迴圈上只把 record 放進佇列,
+    實際的格式化與寫入由背景執行緒處理,不會阻塞 bot
+    """
+    global _listener, PROGRESS_LOG_EVERY
+    if _listener:
+        return
+    PROGRESS_LOG_EVERY = progress_every
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)